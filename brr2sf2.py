@@ -4,9 +4,13 @@
 ## made with reference to vgmtrans & brrtools source
 ## and BRR docs/code on wiki.superfamicom.org
 
-import os, sys, configparser, traceback, re
+import os, sys, io, contextlib, configparser, traceback, re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from math import log, modf
 import mml2mfvi
+from brrdecode import BrrDecoder, LoopAnalyzer
+from brrcache import BrrCache, DEFAULT_CACHE_DIR
 
 SAMPLE_EXTRA_ITERATIONS = 1
 SAMPLE_MIN_SIZE = 4000
@@ -89,9 +93,6 @@ release_table = {
     30: 37,
     31: 28 }
     
-pre = 0
-prepre = 0
-
 clamp = lambda nmin, n, nmax: nmin if n < nmin else (nmax if n > nmax else n)
 
 def text_clamp(text, length):
@@ -103,7 +104,7 @@ def text_clamp(text, length):
     return text
     
 class BrrSample:
-    def __init__(self, idx, text):
+    def __init__(self, idx, text, listpath="", transpose=USE_LISTFILE_TRANSPOSE):
         # parse text - from insertmfvi "Sample.init_from_listfile"
         text = [s.strip() for s in text.split(',')]
         if not text:
@@ -145,7 +146,7 @@ class BrrSample:
                 self.name = self.name.rpartition('/')[2]
             if '\\' in self.name:
                 self.name = self.name.rpartition('\\')[2]
-        if coarsetune is not None and USE_LISTFILE_TRANSPOSE:
+        if coarsetune is not None and transpose:
             coarsetune = coarsetune.group(0)[1:-1].strip()
             try:
                 self.coarsetune = int(coarsetune) * -1
@@ -249,64 +250,75 @@ class BrrSample:
                 # return False
         return True
         
-    def get_pcm(self):
-        global pre, prepre
-        pre = 0
-        prepre = 0
-        # print(f"getpcm {self.idx:02X}")
+    def decode(self):
+        # Decode until the sample ends or the state at its loop point repeats.
+        # What this finds doesn't depend on the SAMPLE_ settings, so it can be
+        # cached and extended differently later.
+        decoder = BrrDecoder(self.brr)
+        analyzer = LoopAnalyzer()
+        info = {"blocks": self.length, "loops": 0, "truncated": None,
+                "period_start": None, "period_iterations": 0}
         
         pcm = bytearray()
         loc = self.offset
         loops = 0
         while True:
-            block = self.brr[loc:loc+9]
-            if len(block) != 9:
-                print(f"WARNING: truncated block at {loc:04X} - expected length 9, got length {len(block)}")
-                print(f"aborting processing for this sample, press enter to continue")
-                input()
+            if loc == self.loffset:
+                first = analyzer.visit(loc, decoder, len(pcm))
+                if first is not None:
+                    # decoding from here on would only repeat pcm[period_start:]
+                    info["period_start"] = analyzer.starts[first]
+                    info["period_iterations"] = len(analyzer.starts) - 1 - first
+                    break
+                    
+            # decode up to the next end block in one go
+            count, head = decoder.run_length(loc)
+            pcm += decoder.decode(loc, count)
+            if head is None:
+                info["truncated"] = loc + count * 9
                 break
-            pcm_samples = decode_block(block)
-            print(".", end="")
-            for p in pcm_samples:
-                pcm.extend(p.to_bytes(2, "little", signed=True))
             
-            if block[0] & 0b11 == 0b11:
-                if loops >= SAMPLE_EXTRA_ITERATIONS and len(pcm) >= SAMPLE_MIN_SIZE:
-                    valid = self.validate_loop(pcm)
-                    if valid:
-                        self.llength *= valid
-                        print(f"\n  Loop extended by {valid}x (total iterations {loops+1})")
-                        print(f"  loop size {self.llength}, sample size {len(pcm)}")
-                        break
+            if head & 0b11 == 0b11:
                 loops += 1
                 loc = self.loffset
                 # print(f"  adding {loops+1}rd iteration")
                 continue
-            elif block[0] & 1:
-                break
+            break
+        info["loops"] = loops
+        return pcm, info
+        
+    def get_pcm(self, cache=None):
+        # print(f"getpcm {self.idx:02X}")
+        key = cache.key(self.brr, self.offset, self.loffset) if cache else None
+        cached = cache.get(key) if cache else None
+        if cached:
+            pcm, info = cached
+            pcm = bytearray(pcm)
+        else:
+            pcm, info = self.decode()
+            if cache:
+                cache.put(key, pcm, info)
                 
-            loc += 9
-            if loc > self.offset + self.length * 9:
-                print(f"why are we at {loc:04X} when sample {self.idx:02X} at {self.offset:04X} is only {self.length} blocks long? we should have gotten there by {self.offset + self.length * 9:04X}")
-                input()
+        if info["truncated"] is not None:
+            loc = info["truncated"]
+            print(f"WARNING: sample {self.idx:02X}: truncated block at {loc:04X} - expected length 9, got length {len(self.brr[loc:loc+9])}")
+            print(f"aborting processing for this sample")
+        elif info["period_start"] is not None:
+            # Repeat the period until the sample is long enough, with at least
+            # one extra period so the loop has a full copy behind it.
+            period = pcm[info["period_start"]:]
+            iterations = info["period_iterations"]
+            loops = info["loops"]
+            while True:
+                pcm += period
+                loops += iterations
+                if loops >= SAMPLE_EXTRA_ITERATIONS and len(pcm) >= SAMPLE_MIN_SIZE:
+                    break
+            self.llength = len(period) // 32
+            print(f"  Sample {self.idx:02X}: loop extended by {iterations}x (total iterations {loops+1})")
+            print(f"  loop size {self.llength}, sample size {len(pcm)}")
         return pcm
         
-    def validate_loop(self, pcm):
-        llen = self.llength * 16
-        lsp = len(pcm) - llen
-        lscale = 1
-        while True:
-            lsp = len(pcm) - llen * lscale
-            prelsp = lsp - llen * lscale
-            if prelsp <= self.length:
-                break
-            #print(f"  trying {lscale}x ({lsp} / {len(pcm)})")
-            if pcm[lsp:] == pcm[prelsp:lsp]:
-                #print(f"  found match with period {lscale}x original loop size")
-                return lscale
-            lscale += 1
-        return False
-            
     def get_tuning(self):
         semitones = 12 * (log(self.pitch_scale, 10) / log(2, 10))
         cents, semitones = modf(semitones)
@@ -332,54 +344,35 @@ class BrrSample:
         min = clamp(0, 0 - self.coarsetune, max) if self.coarsetune else 0
         return (max << 8) + min
         
-def decode_block(block):
-    global pre, prepre
-    assert len(block) == 9
-    head = block[0]
-    filtermode = (head & 0b1100) >> 2
-    shiftrange = head >> 4
-    # print(f"filter {filtermode} shift {shiftrange}")
-    
-    nybs = []
-    pcms = []
-    for byt in block[1:]:
-        nybs.append(byt >> 4)
-        nybs.append(byt & 0x0F)
-    # print(nybs)
-    for n in nybs:
-        if n >= 8:
-            n -= 16
-        if shiftrange > 13:
-            pcm = (-1 if n < 0 else 1) << 11
-        else:
-            pcm = n << shiftrange >> 1
-        debug_shifted = pcm
-        
-        if filtermode == 0:
-            filter = 0
-        elif filtermode == 1:
-            filter = pre + ((-1 * pre) >> 4)
-        elif filtermode == 2:
-            filter = (pre << 1) + ((-1*((pre << 1) + pre)) >> 5) - prepre + (prepre >> 4)
-        elif filtermode == 3:
-            filter = (pre << 1) + ((-1*(pre + (pre << 2) + (pre << 3))) >> 6) - prepre + (((prepre << 1) + prepre) >> 4)
-        pcm += filter
-        debug_filtered = pcm
-        
-        pcm = clamp(-0x8000, pcm, 0x7FFF)
-        if pcm > 0x3FFF:
-            pcm -= 0x8000
-        elif pcm < -0x4000:
-            pcm += 0x8000
-        # print(f"{debug_shifted} -> {debug_filtered} ({filter}) -> {pcm}")
-        pcms.append(pcm)
-        prepre = pre
-        pre = pcm
-    return pcms
-    
 def chunkify(data, name):
     return bytearray(name, "latin-1") + len(data).to_bytes(4, "little") + data
     
+class RiffWriter:
+    # Writes RIFF chunks directly to a file. Each chunk's size is written as
+    # a placeholder when it begins and filled in when it ends, so chunk
+    # contents never need to be held in memory.
+    def __init__(self, f):
+        self.f = f
+        self.open_chunks = []
+        
+    def begin(self, name, form=""):
+        self.f.write(bytes(name, "latin-1") + b"\x00\x00\x00\x00")
+        self.open_chunks.append(self.f.tell())
+        self.f.write(bytes(form, "latin-1"))
+        
+    def write(self, data):
+        self.f.write(data)
+        
+    def chunk(self, name, data):
+        self.f.write(chunkify(data, name))
+        
+    def end(self):
+        start = self.open_chunks.pop()
+        end = self.f.tell()
+        self.f.seek(start - 4)
+        self.f.write((end - start).to_bytes(4, "little"))
+        self.f.seek(end)
+        
 def generator(id, val, signed=True):
     return bytearray(id.to_bytes(2, "little") + val.to_bytes(2, "little", signed=signed))
     
@@ -418,28 +411,17 @@ def attenuate(pct):
 ##         
 ## print (f"Accepted samples: {[f'{k:02X}' for k in brrs.keys()]}")
 
-try:
-    print("mfvitools brr2sf2")
-    print("usage: brr2sf2.py LISTFILE [sort] [id] [@SAMPLEPATH]")
-    print()
-    
-    if len(sys.argv) >= 2:
-        listfn = sys.argv[1]
-    else:
-        print("BRR list filename:")
-        listfn = input()
-    listfn = listfn.strip('"').strip()
-    listpath, listname = os.path.split(listfn)
+DEFAULT_OPTIONS = {
+    "sort": SORT_BY_BLOCKSIZE,          # renumber each bank's samples in order of size
+    "id": USE_ID_IN_NAMES,              # include sample IDs in names
+    "transpose": USE_LISTFILE_TRANSPOSE,
+    "samplepath": None,                 # sample file location (default: listfile's directory)
+    "outfile": None,                    # default: listfile name with .sf2, in the current directory
+    "jobs": None,                       # decoding processes (default: one per CPU; 1 to decode in-process)
+    "cache": DEFAULT_CACHE_DIR,         # decoded sample cache location (None to always decode)
+    }
     
-    if len(sys.argv) >= 3:
-        if "sort" in [a.strip() for a in sys.argv[2:]]:
-            SORT_BY_BLOCKSIZE = True
-        if "id" in [a.strip() for a in sys.argv[2:]]:
-            USE_ID_IN_NAMES = True
-        for arg in [a.strip() for a in sys.argv[2:]]:
-            if len(arg) and arg[0] == "@":
-                listpath = arg[1:]
-            
+def read_listfile(listfn, listpath, transpose=USE_LISTFILE_TRANSPOSE):
     #listfile = configparser.ConfigParser()
     #listfile.read(listfn)
     with open(listfn, "r") as f:
@@ -494,41 +476,45 @@ try:
             print(f"no free id for {line}")
             continue
         used_ids.add(id)
-        brrs[id] = BrrSample(id, line)
+        brrs[id] = BrrSample(id, line, listpath, transpose)
     # brrs = {k: v for k, v in brrs.items() if v.is_valid() and len(v.brr)}
+    return brrs
     
-    if SORT_BY_BLOCKSIZE:
-        brrs_sorted = {}
-        for i in range(128):
-            bank = []
-            for j in range(128):
-                if (i * 128) + j in brrs:
-                    bank.append(brrs[i * 128 + j])
-            bank = sorted(bank, key=lambda x: x.length)
-            for j in range(len(bank)):
-                bank[j].idx = i * 128 + j
-                brrs_sorted[i * 128 + j] = bank[j]
-        brrs = brrs_sorted
-                
-    ##### Build sample data chunk
-
-    smp_data = bytearray()
-
-    print("Building waveforms")
-    for k, s in brrs.items():
-        print(f"\nconverting BRR to PCM: {k:02X}", end="")
-        s.sdta_offset = len(smp_data) // 2
-        smp_data.extend(s.get_pcm())
-        s.sdta_end = len(smp_data) // 2
-        smp_data.extend(b"\x00\x00" * 46)
-        if len(smp_data) % 2:
-            smp_data.append(b"\x00")
-         
-    sdta_chunk = chunkify(smp_data, "sdtasmpl")
-    sdta_list = chunkify(sdta_chunk, "LIST")
-
-    ##### Build articulation data chunk
+def sort_by_blocksize(brrs):
+    brrs_sorted = {}
+    for i in range(128):
+        bank = []
+        for j in range(128):
+            if (i * 128) + j in brrs:
+                bank.append(brrs[i * 128 + j])
+        bank = sorted(bank, key=lambda x: x.length)
+        for j in range(len(bank)):
+            bank[j].idx = i * 128 + j
+            brrs_sorted[i * 128 + j] = bank[j]
+    brrs = brrs_sorted
+    return brrs
+    
+def decode_sample(sample, cache_dir=None):
+    # Runs in a worker process. get_pcm can extend the loop, so the new loop
+    # length is sent back along with the PCM.
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        pcm = sample.get_pcm(BrrCache(cache_dir) if cache_dir else None)
+    return pcm, sample.llength, log.getvalue()
+    
+def decode_samples(samples, jobs=None, cache_dir=None):
+    # PCM for each sample, in order, as soon as it and every sample before
+    # it are done
+    decode = partial(decode_sample, cache_dir=cache_dir)
+    if jobs == 1 or len(samples) <= 1:
+        yield from map(decode, samples)
+        return
+    with ProcessPoolExecutor(jobs) as pool:
+        yield from pool.map(decode, samples)
+        
+##### Build articulation data chunk
 
+def write_articulation(riff, brrs, use_id=USE_ID_IN_NAMES):
     sfPresetHeader = bytearray()
     sfPresetBag = bytearray()
     sfModList = chunkify(b"\x00" * 10, "pmod")
@@ -546,7 +532,7 @@ try:
             continue
         i += 1
         # name = text_clamp(f"brr{s.idx:02X} ({s.length})", 20)
-        if USE_ID_IN_NAMES:
+        if use_id:
             name_id = f"{s.idx:02X}"
             name_block = f"{s.length}"
             name_freespace = 18 - len(name_id) - len(name_block)
@@ -682,39 +668,122 @@ try:
     sfInstGenList += b"\x00" * 4
     sfGenList += b"\x00" * 4
 
-    # pack 'em up
-    pdta_chunk = chunkify(sfPresetHeader, "pdtaphdr")
-    pdta_chunk += chunkify(sfPresetBag, "pbag")
-    pdta_chunk += sfModList
-    pdta_chunk += chunkify(sfGenList, "pgen")
-    pdta_chunk += chunkify(sfInst, "inst")
-    pdta_chunk += chunkify(sfInstBag, "ibag")
-    pdta_chunk += sfInstModList
-    pdta_chunk += chunkify(sfInstGenList, "igen")
-    pdta_chunk += chunkify(sfSample, "shdr")
-    pdta_list = chunkify(pdta_chunk, "LIST")
 
-    # INFO_list
-    info_chunk = bytearray()
-    info_chunk += chunkify(b"\x02\x00\x04\x00", "INFOifil")
-    info_chunk += chunkify(bytes("EMU8000", "latin-1") + b"\x00", "isng")
+    # pack 'em up
+    riff.begin("LIST", "pdta")
+    riff.chunk("phdr", sfPresetHeader)
+    riff.chunk("pbag", sfPresetBag)
+    riff.write(sfModList)
+    riff.chunk("pgen", sfGenList)
+    riff.chunk("inst", sfInst)
+    riff.chunk("ibag", sfInstBag)
+    riff.write(sfInstModList)
+    riff.chunk("igen", sfInstGenList)
+    riff.chunk("shdr", sfSample)
+    riff.end()
     
+def build_soundfont(listfile, options=None, progress=None):
+    # Convert the samples in a listfile into a soundfont and return its
+    # filename. options is a dict overriding DEFAULT_OPTIONS. progress, if
+    # given, is called as progress(done, total, sample) after each sample's
+    # waveform has been written; samples are always written in listfile
+    # (or sorted) order regardless of which finishes decoding first.
+    opts = dict(DEFAULT_OPTIONS)
+    if options:
+        opts.update(options)
+        
+    listpath, listname = os.path.split(listfile)
+    if opts["samplepath"] is not None:
+        listpath = opts["samplepath"]
+    brrs = read_listfile(listfile, listpath, opts["transpose"])
+    if opts["sort"]:
+        brrs = sort_by_blocksize(brrs)
+        
     listname = listname.rpartition('.')[0]
-    outfn = listname + ".sf2"
+    outfn = opts["outfile"] if opts["outfile"] else listname + ".sf2"
     listname = bytes(listname, "latin-1") + b"\x00"
     if len(listname) % 2:
         listname += b"\x00"
-    info_chunk += chunkify(listname, "INAM")
-    info_list = chunkify(info_chunk, "sfbkLIST")
-
-    sfbk_chunk = info_list + sdta_list + pdta_list
-    sfbk_riff = chunkify(sfbk_chunk, "RIFF")
-
-    with open(outfn, "wb+") as f:
-        f.write(sfbk_riff)
-        
-    print("done.")
-    input()
-except:
-    traceback.print_exc()
-    input()
\ No newline at end of file
+        
+    # Sample data goes straight to disk as it is decoded; the file is only
+    # moved into place once it is complete, and removed if anything fails
+    tmpfn = outfn + ".tmp"
+    try:
+        with open(tmpfn, "wb") as outf:
+            riff = RiffWriter(outf)
+            riff.begin("RIFF", "sfbk")
+            
+            # INFO_list
+            riff.begin("LIST", "INFO")
+            riff.chunk("ifil", b"\x02\x00\x04\x00")
+            riff.chunk("isng", bytes("EMU8000", "latin-1") + b"\x00")
+            riff.chunk("INAM", listname)
+            riff.end()
+            
+            ##### Build sample data chunk
+            
+            print("Building waveforms")
+            riff.begin("LIST", "sdta")
+            riff.begin("smpl")
+            smp_length = 0
+            samples = list(brrs.values())
+            for done, (s, (pcm, llength, log)) in enumerate(zip(samples, decode_samples(samples, opts["jobs"], opts["cache"])), 1):
+                s.llength = llength
+                print(log, end="")
+                s.sdta_offset = smp_length // 2
+                s.sdta_end = (smp_length + len(pcm)) // 2
+                riff.write(pcm)
+                riff.write(b"\x00\x00" * 46)
+                smp_length += len(pcm) + 92
+                if progress:
+                    progress(done, len(samples), s)
+            riff.end()
+            riff.end()
+            
+            write_articulation(riff, brrs, opts["id"])
+            riff.end()
+        os.replace(tmpfn, outfn)
+    except BaseException:
+        try:
+            os.remove(tmpfn)
+        except OSError:
+            pass
+        raise
+    return outfn
+    
+if __name__ == "__main__":
+    import argparse
+    print("mfvitools brr2sf2")
+    print()
+    
+    parser = argparse.ArgumentParser(description="Convert the BRR samples in a listfile to a soundfont.")
+    parser.add_argument("listfile")
+    parser.add_argument("flags", nargs="*", metavar="FLAG", help="legacy flags: sort, id, @SAMPLEPATH (same as --sort, --id, --samplepath SAMPLEPATH)")
+    parser.add_argument("--sort", action="store_true", help="renumber each bank's samples in order of size")
+    parser.add_argument("--id", action="store_true", help="include sample IDs in names")
+    parser.add_argument("--samplepath", help="directory the listfile's samples are in (default: the listfile's directory)")
+    parser.add_argument("-o", "--outfile", help="soundfont to write (default: LISTNAME.sf2 in the current directory)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes to decode with (default: one per CPU)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_DIR, help=f"directory to cache decoded samples in (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--no-cache", action="store_true", help="decode every sample, without reading or writing the cache")
+    args = parser.parse_args()
+    
+    options = {"sort": args.sort, "id": args.id, "samplepath": args.samplepath,
+               "outfile": args.outfile, "jobs": args.jobs, "cache": None if args.no_cache else args.cache}
+    for flag in [a.strip() for a in args.flags]:
+        if flag == "sort":
+            options["sort"] = True
+        elif flag == "id":
+            options["id"] = True
+        elif flag.startswith("@"):
+            options["samplepath"] = flag[1:]
+            
+    def print_progress(done, total, sample):
+        print(f"[{done}/{total}] converted BRR to PCM: {sample.idx:02X}")
+        
+    try:
+        outfn = build_soundfont(args.listfile.strip('"').strip(), options, progress=print_progress)
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
+    print(f"done. wrote {outfn}")
@@ -0,0 +1,70 @@
+# BRRCACHE - content-addressed cache of decoded BRR samples
+#
+# Entries are keyed by a SHA-256 of the BRR data plus the offsets decoding
+# starts and loops from, so a sample is only ever decoded once no matter
+# which file or tool it comes from, or what it's called. Each entry is the
+# decoded PCM as raw little-endian int16 (memory-mapped when read back) and
+# a small JSON file describing it: block count, whether and where it ended
+# early, and the loop period found for it.
+
+import os
+import json
+import mmap
+import hashlib
+
+# Bump when decoding changes, so old entries are ignored
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.environ.get("MFVITOOLS_CACHE") or os.path.join(os.path.expanduser("~"), ".cache", "mfvitools")
+
+class BrrCache():
+    def __init__(self, path=DEFAULT_CACHE_DIR):
+        self.path = os.path.join(path, f"brr{CACHE_VERSION}")
+
+    @staticmethod
+    def key(brr, offset=0, loop=0):
+        return f"{hashlib.sha256(brr).hexdigest()}_{offset:X}_{loop:X}"
+
+    def files(self, key):
+        folder = os.path.join(self.path, key[:2])
+        return os.path.join(folder, key + ".pcm"), os.path.join(folder, key + ".json")
+
+    def info(self, key):
+        # Description of a cached sample, or None if it isn't cached
+        try:
+            with open(self.files(key)[1], "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key):
+        # (pcm, info) for a cached sample, or None. pcm is read-only and
+        # backed by the cache file, so it costs nothing until it is read.
+        info = self.info(key)
+        if info is None:
+            return None
+        try:
+            with open(self.files(key)[0], "rb") as f:
+                if info.get("pcm_length") == 0:
+                    pcm = b""
+                else:
+                    pcm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(pcm) != info.get("pcm_length"):
+            return None
+        return pcm, info
+
+    def put(self, key, pcm, info):
+        # Entries are written under temporary names and moved into place,
+        # so parallel writers and interrupted runs never leave a partial one
+        pcmfn, infofn = self.files(key)
+        info = dict(info, pcm_length=len(pcm))
+        try:
+            os.makedirs(os.path.dirname(pcmfn), exist_ok=True)
+            for fn, mode, data in ((pcmfn, "wb", pcm), (infofn, "w", json.dumps(info))):
+                tmpfn = fn + f".{os.getpid()}.tmp"
+                with open(tmpfn, mode) as f:
+                    f.write(data)
+                os.replace(tmpfn, fn)
+        except OSError:
+            print(f"WARNING: couldn't write {key} to BRR cache at {self.path}")
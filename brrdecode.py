@@ -0,0 +1,169 @@
+# BRRDECODE - BRR sample decoder shared by the BRR tools
+#
+# Decodes runs of blocks at a time instead of one block per call. Everything
+# that doesn't depend on filter history -- unpacking nybbles, applying the
+# range shift, and the whole of any block that uses filter 0 -- is worked out
+# for the entire sample up front (with numpy, if it's installed). The
+# recursive filters then run in one tight loop over a preallocated int16
+# array. Output is identical to the old block-by-block decoder in brr2sf2.
+
+import sys
+from array import array
+from bisect import bisect_left
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BLOCK_SIZE = 9
+BLOCK_SAMPLES = 16
+
+# Range-shifted value of each nybble, by range and byte: (high, low)
+def _shift_nybble(n, shiftrange):
+    if n >= 8:
+        n -= 16
+    if shiftrange > 13:
+        return (-1 if n < 0 else 1) << 11
+    return n << shiftrange >> 1
+
+shift_table = [[(_shift_nybble(b >> 4, r), _shift_nybble(b & 0x0F, r)) for b in range(0x100)]
+               for r in range(0x10)]
+
+def wrap(pcm):
+    # clamp to 16 bits, then wrap into 15 bits as the DSP does
+    if pcm > 0x3FFF:
+        return -1 if pcm > 0x7FFF else pcm - 0x8000
+    if pcm < -0x4000:
+        return 0 if pcm < -0x8000 else pcm + 0x8000
+    return pcm
+
+class BrrBlocks():
+    # All complete blocks of a BRR that start at offsets congruent to phase
+    # (mod 9). Well-formed samples only ever need phase 0, but a loop point
+    # that isn't a multiple of 9 reads the same data on a different grid.
+    def __init__(self, brr, phase):
+        self.phase = phase
+        count = max(0, (len(brr) - phase) // BLOCK_SIZE)
+        self.count = count
+        raw = brr[phase:phase + count * BLOCK_SIZE]
+        self.heads = raw[::BLOCK_SIZE]
+        # indices of blocks with the end flag set
+        self.ends = [i for i, head in enumerate(self.heads) if head & 1]
+
+        if np is not None and count:
+            blocks = np.frombuffer(bytes(raw), dtype=np.uint8).reshape(count, BLOCK_SIZE)
+            nybbles = np.empty((count, BLOCK_SAMPLES), dtype=np.int32)
+            nybbles[:, 0::2] = blocks[:, 1:] >> 4
+            nybbles[:, 1::2] = blocks[:, 1:] & 0x0F
+            nybbles[nybbles >= 8] -= 16
+            ranges = (blocks[:, :1] >> 4).astype(np.int32)
+            shifted = np.where(ranges > 13, np.where(nybbles < 0, -1 << 11, 1 << 11),
+                               (nybbles << np.minimum(ranges, 13)) >> 1)
+            # filter 0 blocks only need clamping and wrapping
+            final = np.where(shifted > 0x3FFF, shifted - 0x8000,
+                             np.where(shifted < -0x4000, shifted + 0x8000, shifted))
+            self.shifted = shifted.ravel().tolist()
+            self.unfiltered = final.ravel().tolist()
+        else:
+            shifted = []
+            for i in range(count):
+                table = shift_table[raw[i * BLOCK_SIZE] >> 4]
+                for b in raw[i * BLOCK_SIZE + 1:(i + 1) * BLOCK_SIZE]:
+                    shifted.extend(table[b])
+            self.shifted = shifted
+            self.unfiltered = [wrap(p) for p in shifted]
+
+class BrrDecoder():
+    # Decoder for one BRR sample. decode() continues from the filter state
+    # left by the previous call, so a looping sample is decoded by decoding
+    # its attack and then its loop as many times as needed.
+    def __init__(self, brr):
+        self.brr = bytes(brr)
+        self._grids = {}
+        self.reset()
+
+    def reset(self):
+        self.pre = 0
+        self.prepre = 0
+
+    def grid(self, offset):
+        phase = offset % BLOCK_SIZE
+        if phase not in self._grids:
+            self._grids[phase] = BrrBlocks(self.brr, phase)
+        return self._grids[phase]
+
+    def run_length(self, offset):
+        # Number of blocks from offset up to and including the first block
+        # with the end flag, and the header of that block. If the data ends
+        # first, that header is None and the count covers the complete
+        # blocks that are there.
+        grid = self.grid(offset)
+        first = (offset - grid.phase) // BLOCK_SIZE
+        i = bisect_left(grid.ends, first)
+        if i < len(grid.ends):
+            last = grid.ends[i]
+            return last - first + 1, grid.heads[last]
+        return max(0, grid.count - first), None
+
+    def decode(self, offset, count):
+        # Decode count blocks starting at offset, as little-endian int16 PCM
+        grid = self.grid(offset)
+        first = (offset - grid.phase) // BLOCK_SIZE
+        heads, shifted, unfiltered = grid.heads, grid.shifted, grid.unfiltered
+        pcm = array("h", bytes(count * BLOCK_SAMPLES * 2))
+        pre, prepre = self.pre, self.prepre
+        pos = 0
+        for block in range(first, first + count):
+            mode = (heads[block] >> 2) & 0b11
+            start = block * BLOCK_SAMPLES
+            if mode == 0:
+                pcm[pos:pos + BLOCK_SAMPLES] = array("h", unfiltered[start:start + BLOCK_SAMPLES])
+                pos += BLOCK_SAMPLES
+                pre, prepre = pcm[pos - 1], pcm[pos - 2]
+                continue
+            for p in shifted[start:start + BLOCK_SAMPLES]:
+                if mode == 1:
+                    p += pre + ((-pre) >> 4)
+                elif mode == 2:
+                    p += (pre << 1) + ((-3 * pre) >> 5) - prepre + (prepre >> 4)
+                else:
+                    p += (pre << 1) + ((-13 * pre) >> 6) - prepre + ((3 * prepre) >> 4)
+                if p > 0x3FFF:
+                    p = -1 if p > 0x7FFF else p - 0x8000
+                elif p < -0x4000:
+                    p = 0 if p < -0x8000 else p + 0x8000
+                prepre = pre
+                pre = p
+                pcm[pos] = p
+                pos += 1
+        self.pre, self.prepre = pre, prepre
+        if sys.byteorder != "little":
+            pcm.byteswap()
+        return pcm.tobytes()
+
+class LoopAnalyzer():
+    # Finds the exact period of a looping sample from the decoder state at
+    # the start of each pass through the loop. Output only depends on the
+    # position and the filter history, so once (position, pre, prepre)
+    # repeats, everything decoded after it repeats as well.
+    def __init__(self):
+        self.seen = {}
+        # PCM length (in bytes) at the start of each pass
+        self.starts = []
+
+    def visit(self, offset, decoder, pcm_length):
+        # Record a pass starting at offset. Returns the index of the earlier
+        # pass with the same state, or None if this state is new.
+        key = (offset, decoder.pre, decoder.prepre)
+        first = self.seen.get(key)
+        if first is None:
+            self.seen[key] = len(self.starts)
+        self.starts.append(pcm_length)
+        return first
+
+def decode_brr(brr, offset=0):
+    # PCM for a sample played once from offset to its end block
+    decoder = BrrDecoder(brr)
+    count, _ = decoder.run_length(offset)
+    return decoder.decode(offset, count)
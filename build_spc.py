@@ -1,5 +1,6 @@
 import os
 import sys
+from collections import namedtuple
 
 from mml2mfvi import byte_insert, int_insert
 
@@ -26,6 +27,10 @@ POINTER_TO_BRR_ENV = 0x504DE
 POINTER_TO_BRR_PITCH = 0x5049C
 POINTER_TO_INST_TABLE = 0x501E3
 POINTER_TO_SEQ_POINTERS = 0x50539
+SONG_COUNT_OFFSET = 0x53C5E
+
+# loop, env and pitch are the raw two-byte table entries
+RomSample = namedtuple("RomSample", "pointer brr loop env pitch")
 
 
 def end_with_message(message, pause=True):
@@ -72,134 +77,195 @@ def print_bytes(bin, group=2):
             count = 0
     return s.strip()
     
-def build_samples(rom, song_idx):
-    
-    static_brr_offset = read_pointer(rom, POINTER_TO_STATIC_BRR, 2) + SPC_ENGINE_BANK_START
-    static_ptr_offset = read_pointer(rom, POINTER_TO_STATIC_PTR, 2) + SPC_ENGINE_BANK_START
-    static_env_offset = read_pointer(rom, POINTER_TO_STATIC_ENV, 2) + SPC_ENGINE_BANK_START
-    static_pitch_offset = read_pointer(rom, POINTER_TO_STATIC_PITCH, 2) + SPC_ENGINE_BANK_START
+class RomIndex():
+    # Pointer tables of one ROM, read once so that many songs can be pulled
+    # from the same ROM without resolving every pointer again for each one
     
-    static_brr_data = load_data_from_rom(rom, static_brr_offset)
-    static_brr_ptr = load_data_from_rom(rom, static_ptr_offset)
-    static_brr_env = load_data_from_rom(rom, static_env_offset)
-    static_brr_pitch = load_data_from_rom(rom, static_pitch_offset)
+    def __init__(self, rom):
+        self.rom = rom
+        self.song_count = rom[SONG_COUNT_OFFSET]
+        
+        self.spc_engine_offset = read_pointer(rom, POINTER_TO_SPC_ENGINE, 2) + SPC_ENGINE_BANK_START
+        self.sfx_seq_offset = read_pointer(rom, POINTER_TO_SFX_SEQ, 2) + SPC_ENGINE_BANK_START
+        self.static_brr_offset = read_pointer(rom, POINTER_TO_STATIC_BRR, 2) + SPC_ENGINE_BANK_START
+        self.static_ptr_offset = read_pointer(rom, POINTER_TO_STATIC_PTR, 2) + SPC_ENGINE_BANK_START
+        self.static_env_offset = read_pointer(rom, POINTER_TO_STATIC_ENV, 2) + SPC_ENGINE_BANK_START
+        self.static_pitch_offset = read_pointer(rom, POINTER_TO_STATIC_PITCH, 2) + SPC_ENGINE_BANK_START
+        
+        self.brr_pointer_offset = read_pointer(rom, POINTER_TO_BRR_POINTERS)
+        self.brr_loop_offset = read_pointer(rom, POINTER_TO_BRR_LOOPS)
+        self.brr_env_offset = read_pointer(rom, POINTER_TO_BRR_ENV)
+        self.brr_pitch_offset = read_pointer(rom, POINTER_TO_BRR_PITCH)
+        self.inst_table_offset = read_pointer(rom, POINTER_TO_INST_TABLE)
+        self.seq_pointer_offset = read_pointer(rom, POINTER_TO_SEQ_POINTERS)
+        
+        self._samples = {}
+        
+    def sequence_offset(self, song_idx):
+        return read_pointer(self.rom, self.seq_pointer_offset + song_idx * 3)
+        
+    def sequence(self, song_idx):
+        # Sequence data as loaded into SPC RAM (including the extra byte)
+        return load_data_from_rom(self.rom, self.sequence_offset(song_idx), seq=True)
+        
+    def inst_table(self, song_idx):
+        loc = song_idx * 0x20 + self.inst_table_offset
+        return self.rom[loc:loc+0x20]
+        
+    def instruments(self, song_idx):
+        # Sample IDs for program slots 0x20-0x2F; 0 where the slot is unused
+        table = self.inst_table(song_idx)
+        return [int.from_bytes(table[i*2:i*2+2], "little") for i in range(16)]
+        
+    def sample(self, inst_id):
+        # Sample data and parameters for a (1-based) sample ID
+        if inst_id not in self._samples:
+            inst_idx = inst_id - 1
+            loc = self.brr_pointer_offset + 3 * inst_idx
+            pointer = read_pointer(self.rom, loc)
+            loc = self.brr_loop_offset + 2 * inst_idx
+            loop = self.rom[loc:loc+2]
+            loc = self.brr_env_offset + 2 * inst_idx
+            env = self.rom[loc:loc+2]
+            loc = self.brr_pitch_offset + 2 * inst_idx
+            pitch = self.rom[loc:loc+2]
+            self._samples[inst_id] = RomSample(pointer, load_data_from_rom(self.rom, pointer), loop, env, pitch)
+        return self._samples[inst_id]
+        
+# Template files only need to be read once per process
+_spc_templates = None
 
-    brr_pointer_offset = read_pointer(rom, POINTER_TO_BRR_POINTERS)
-    brr_loop_offset = read_pointer(rom, POINTER_TO_BRR_LOOPS)
-    brr_env_offset = read_pointer(rom, POINTER_TO_BRR_ENV)
-    brr_pitch_offset = read_pointer(rom, POINTER_TO_BRR_PITCH)
-    inst_table_offset = read_pointer(rom, POINTER_TO_INST_TABLE)
-    
-    print(f"BRR pointers at {brr_pointer_offset:06X}")
-    print(f"loop, ADSR, tuning at {brr_loop_offset:06X}, {brr_env_offset:06X}, {brr_pitch_offset:06X}")
+def load_spc_templates():
+    global _spc_templates
+    if _spc_templates is None:
+        _spc_templates = (load_binary_file(SPC_WORK_RAM_FILE, expected_size = 0x300),
+                          load_binary_file(SPC_AUX_RAM_FILE, expected_size = 0xB00))
+    return _spc_templates
     
-    free_brr_offset = 0x4800 + len(static_brr_data)
+def put(buffer, position, newdata):
+    # byte_insert, in place, for positions within the buffer
+    buffer[position:position+len(newdata)] = newdata
     
-    all_brr_data = bytearray(static_brr_data)
-    dyn_brr_ptr = bytearray(0x40)
-    dyn_brr_env = bytearray(0x20)
-    dyn_brr_pitch = bytearray(0x20)
+class SpcBuilder():
+    # Builds SPC images of songs from one ROM. Everything that is the same for
+    # every song -- templates, engine, SFX, static samples, pointer tables --
+    # is read once here, so each song only costs copying its own data into
+    # a copy of the prepared image.
     
-    loc = song_idx * 0x20 + inst_table_offset
-    inst_table = rom[loc:loc+0x20]
-    print(f"instrument table at {inst_table_offset:06X} + {song_idx * 0x20:X} = {loc:06X}")
-    for i in range(16):
-        inst_id = int.from_bytes(inst_table[i*2:i*2+2], "little")
-        
-        if inst_id:
-            print(f"Loading sample id {inst_id:02X}...")
-            # Offset the sample index because there is no entry for zero
-            inst_idx = inst_id - 1
-            brr_loop = read_pointer(rom, brr_loop_offset + 2 * inst_idx, 2)
-            dyn_brr_ptr = int_insert(dyn_brr_ptr, 4 * i, free_brr_offset, 2)
-            dyn_brr_ptr = int_insert(dyn_brr_ptr, 4 * i + 2, free_brr_offset + brr_loop, 2)
-            
-            loc = brr_env_offset + 2 * inst_idx
-            brr_env = rom[loc:loc+2]
-            dyn_brr_env = byte_insert(dyn_brr_env, 2 * i, brr_env)
+    def __init__(self, rom, index=None, verbose=True):
+        self.rom = rom
+        self.index = index if index is not None else RomIndex(rom)
+        self.verbose = verbose
+        
+        index = self.index
+        self.static_brr_data = load_data_from_rom(rom, index.static_brr_offset)
+        self.sfx_data = load_data_from_rom(rom, index.sfx_seq_offset)
+        
+        # Static halves of the $1A00 patch tables
+        self.meta = bytearray(0x200)
+        put(self.meta, 0x000, load_data_from_rom(rom, index.static_pitch_offset))
+        put(self.meta, 0x080, load_data_from_rom(rom, index.static_env_offset))
+        put(self.meta, 0x100, load_data_from_rom(rom, index.static_ptr_offset))
+        # Per-song halves start out empty, even if a static table overran them
+        put(self.meta, 0x040, bytes(0x20))
+        put(self.meta, 0x0C0, bytes(0x20))
+        put(self.meta, 0x180, bytes(0x40))
+        
+        self.template = None
+        
+    def log(self, message):
+        if self.verbose:
+            print(message)
             
-            loc = brr_pitch_offset + 2 * inst_idx
-            brr_pitch = rom[loc:loc+2]
-            dyn_brr_pitch = byte_insert(dyn_brr_pitch, 2 * i, brr_pitch)
+    def load_template(self):
+        # $100 byte SPC header, then 64KB memory + $100 bytes for DSP registers etc.
+        spc_work_ram, self.spc_aux_ram = load_spc_templates()
+        spc = bytearray(spc_work_ram[:0x100]) + bytearray(0x10100)
+        
+        # $0000 to $0200 - SPC work RAM
+        put(spc, 0x100, spc_work_ram[0x100:0x300])
+        
+        # $0200 to $1A00 - SPC engine code
+        put(spc, 0x300, load_data_from_rom(self.rom, self.index.spc_engine_offset))
+        self.template = spc
+        
+    def build_samples(self, song_idx):
+        index = self.index
+        self.log(f"BRR pointers at {index.brr_pointer_offset:06X}")
+        self.log(f"loop, ADSR, tuning at {index.brr_loop_offset:06X}, {index.brr_env_offset:06X}, {index.brr_pitch_offset:06X}")
+        
+        all_brr_data = bytearray(self.static_brr_data)
+        free_brr_offset = 0x4800 + len(all_brr_data)
+        meta = bytearray(self.meta)
+        
+        self.log(f"instrument table at {index.inst_table_offset:06X} + {song_idx * 0x20:X} = {song_idx * 0x20 + index.inst_table_offset:06X}")
+        for i, inst_id in enumerate(index.instruments(song_idx)):
+            if inst_id:
+                self.log(f"Loading sample id {inst_id:02X}...")
+                sample = index.sample(inst_id)
+                brr_loop = int.from_bytes(sample.loop, "little")
+                put(meta, 0x180 + 4 * i, (free_brr_offset & 0xFFFF).to_bytes(2, "little"))
+                put(meta, 0x182 + 4 * i, ((free_brr_offset + brr_loop) & 0xFFFF).to_bytes(2, "little"))
+                put(meta, 0x0C0 + 2 * i, sample.env)
+                put(meta, 0x040 + 2 * i, sample.pitch)
+                
+                all_brr_data += sample.brr
+                free_brr_offset = 0x4800 + len(all_brr_data)
+                self.log(f"    ROM location {sample.pointer:06X}, size {len(sample.brr)//9} blocks.")
+                
+        return meta, all_brr_data
+        
+    def build(self, song_idx):
+        if self.template is None:
+            self.load_template()
+        # All offsets below are SPC RAM addresses + $100 for the header
+        spc = bytearray(self.template)
+        
+        # $1A00 to $1C00 - patch metadata/pointer tables
+        # $4800 up to $F600 - BRR sample data
+        meta, samples = self.build_samples(song_idx)
+        put(spc, 0x1B00, meta)
+        put(spc, 0x4900, samples)
+        
+        # $1C00 to $2C00 - sequence data
+        # $2C00 to $4800 - SFX pointers and data
+        # Insert SFX first in case of overflow
+        put(spc, 0x2D00, self.sfx_data)
+        
+        # Read sequence
+        seq = self.index.sequence(song_idx)
+        self.log(f"Sequence {song_idx:X} at {self.index.sequence_offset(song_idx):06X} -- {len(seq):0X} bytes")
+        
+        # Append "end track" to keep unused channels from going rogue
+        seq += b"\xEB"
+        put(spc, 0x1D00, seq)
+        
+        # Set track read heads to start of tracks
+        address_base = int.from_bytes(seq[0:2], "little")
+        script_offset = 0x11C24 - address_base
+        while script_offset >= 0x10000:
+            script_offset -= 0x10000
+        self.log(f"ROM address base for sequence: {address_base:04X} / Script offset: {script_offset:04X}")
+        put(spc, 0x100, (script_offset & 0xFFFF).to_bytes(2, "little"))
+        for i in range(8):
+            loc = 4 + i * 2
+            track_start = int.from_bytes(seq[loc:loc+2], "little")
+            track_start -= address_base
+            track_start += 0x1C24
+            self.log(f"track {i} start: ${track_start:04X}")
+            put(spc, 0x102 + i * 2, (track_start & 0xFFFF).to_bytes(2, "little"))
             
-            brr_pointer = read_pointer(rom, brr_pointer_offset + 3 * inst_idx)
-            inst_brr_data = load_data_from_rom(rom, brr_pointer)
-            all_brr_data += inst_brr_data
-            free_brr_offset = 0x4800 + len(all_brr_data)
-            print(f"    ROM location {brr_pointer:06X}, size {len(inst_brr_data)//9} blocks.")
-        
-    meta = bytearray(0x200)
-    meta = byte_insert(meta, 0x000, static_brr_pitch)
-    meta = byte_insert(meta, 0x040, dyn_brr_pitch)
-    meta = byte_insert(meta, 0x080, static_brr_env)
-    meta = byte_insert(meta, 0x0C0, dyn_brr_env)
-    meta = byte_insert(meta, 0x100, static_brr_ptr)
-    meta = byte_insert(meta, 0x180, dyn_brr_ptr)
-    
-    return meta, all_brr_data
+        # $F600 to $FFFF - additional RAM used for track state
+        # $10000 to end - DSP registers, etc.
+        put(spc, 0xF700, self.spc_aux_ram)
+        
+        return bytes(spc)
+        
+def build_samples(rom, song_idx):
+    return SpcBuilder(rom).build_samples(song_idx)
     
 def build_spc(rom, song_idx):
-    
-    # SPC format - 64KB memory + $100 bytes for DSP registers etc. at end
-    spc = bytearray(0x10100)
-    
-    spc_work_ram = load_binary_file(SPC_WORK_RAM_FILE, expected_size = 0x300)
-    spc_aux_ram = load_binary_file(SPC_AUX_RAM_FILE, expected_size = 0xB00)
-    
-    # $100 byte SPC header - keep separate for now
-    header = spc_work_ram[:0x100]
-    
-    # $0000 to $0200 - SPC work RAM
-    spc = byte_insert(spc, 0, spc_work_ram[0x100:0x300])
-    
-    # $0200 to $1A00 - SPC engine code
-    spc_engine_offset = read_pointer(rom, POINTER_TO_SPC_ENGINE, 2) + SPC_ENGINE_BANK_START
-    spc = byte_insert(spc, 0x200, load_data_from_rom(rom, spc_engine_offset))
-    
-    # $1A00 to $1C00 - patch metadata/pointer tables
-    # $4800 up to $F600 - BRR sample data
-    meta, samples = build_samples(rom, song_idx)
-    spc = byte_insert(spc, 0x1A00, meta)
-    spc = byte_insert(spc, 0x4800, samples)
-    
-    # $1C00 to $2C00 - sequence data
-    # $2C00 to $4800 - SFX pointers and data
-    # Insert SFX first in case of overflow
-    loc = read_pointer(rom, POINTER_TO_SFX_SEQ, 2) + SPC_ENGINE_BANK_START
-    spc = byte_insert (spc, 0x2C00, load_data_from_rom(rom, loc))
-    
-    # Read sequence
-    loc = read_pointer(rom, POINTER_TO_SEQ_POINTERS)
-    loc += song_idx * 3
-    loc = read_pointer(rom, loc)
-    seq = load_data_from_rom(rom, loc, seq=True)
-    print(f"Sequence {song_idx:X} at {loc:06X} -- {len(seq):0X} bytes")
-    
-    # Append "end track" to keep unused channels from going rogue
-    seq += b"\xEB"
-    spc = byte_insert(spc, 0x1C00, seq)
-    
-    # Set track read heads to start of tracks
-    address_base = int.from_bytes(seq[0:2], "little")
-    script_offset = 0x11C24 - address_base
-    while script_offset >= 0x10000:
-        script_offset -= 0x10000
-    print(f"ROM address base for sequence: {address_base:04X} / Script offset: {script_offset:04X}")
-    spc = int_insert(spc, 0, script_offset, 2)
-    for i in range(8):
-        loc = 4 + i * 2
-        track_start = int.from_bytes(seq[loc:loc+2], "little")
-        track_start -= address_base
-        track_start += 0x1C24
-        print(f"track {i} start: ${track_start:04X}")
-        loc = 2 + i * 2
-        spc = int_insert(spc, loc, track_start, 2)
-    
-    # $F600 to $FFFF - additional RAM used for track state
-    # $10000 to end - DSP registers, etc.
-    spc = byte_insert(spc, 0xF600, spc_aux_ram)
-    
-    return header + spc
+    return SpcBuilder(rom).build(song_idx)
     
 if __name__ == "__main__":
     print("mfvitools Build SPC tool")
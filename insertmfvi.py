@@ -26,7 +26,9 @@
 #   submitting changes or through creating a fork that other mfvitools
 #   maintainers can easily see and pull from.
 
-import configparser, argparse, sys, shlex, re, os
+import configparser, argparse, sys, shlex, re, os, hashlib, json, io
+import contextlib, multiprocessing, bisect
+from concurrent.futures import ProcessPoolExecutor
 from copy import copy
 
 try:
@@ -85,6 +87,7 @@ def initialize():
     EDL_OFFSET = 0x5076A
     edl = None
 initialize()
+compiler_version = None
 
 class FreeSpaceError(Exception):
     pass
@@ -215,11 +218,25 @@ class Sequence():
                     if self.variant:
                         warning(f"LOADMML: variant '{self.variant}' not found in {self.filename}, using default")
                         self.variant = None
-                self.imports = mml2mfvi.get_brr_imports(self.mml, variant=v)
-                if self.imports:
-                    ifprint(f"DEBUG: got imports {self.imports} for {self.filename}", DEBUG)
-                self.sequence, self.inst = mml2mfvi.mml_to_akao(self.mml, self.filename, variant=v, sfxmode=self.is_sfx)
-                self.edl = mml2mfvi.get_echo_delay(self.mml, variant=v)
+                cache_key = compile_cache_key(self.mml, v, self.is_sfx, self.filename)
+                cached = load_compile_cache(cache_key)
+                if cached:
+                    self.sequence, self.inst, self.imports, self.edl, log = cached
+                    ifprint(f"DEBUG: loaded {self.filename} from compile cache", DEBUG)
+                    # replay the compiler's warnings from when this was cached
+                    print(log, end="")
+                else:
+                    # the compiler's console output is kept with the cache entry
+                    log = io.StringIO()
+                    with contextlib.redirect_stdout(log):
+                        self.imports = mml2mfvi.get_brr_imports(self.mml, variant=v)
+                        self.sequence, self.inst = mml2mfvi.mml_to_akao(self.mml, self.filename, variant=v, sfxmode=self.is_sfx)
+                        self.edl = mml2mfvi.get_echo_delay(self.mml, variant=v)
+                    log = log.getvalue()
+                    print(log, end="")
+                    if self.imports:
+                        ifprint(f"DEBUG: got imports {self.imports} for {self.filename}", DEBUG)
+                    save_compile_cache(cache_key, (self.sequence, self.inst, self.imports, self.edl, log))
                 if self.edl is None:
                     self.edl = edl
             
@@ -338,6 +355,60 @@ class Sample():
                 self.brr = len(brr).to_bytes(2, "little") + brr
                 self.blocksize = (len(self.brr) - 2) // 9
                     
+class SampleIndex():
+    # Finds samples by content. BRR data is keyed by its digest, alone (any
+    # sample with the same waveform, which an import can shadow) and together
+    # with loop/tuning/ADSR (an exact duplicate, which an import can reuse).
+    def __init__(self, sample_defs=None):
+        self.exact = {}
+        self.shadow = {}
+        if sample_defs:
+            for sid, smp in sorted(sample_defs.items()):
+                self.add(sid, smp)
+                
+    @staticmethod
+    def brr_key(smp):
+        return hashlib.sha1(smp.brr).digest()
+        
+    @staticmethod
+    def full_key(smp, brr_key):
+        return (brr_key, bytes(smp.loop), bytes(smp.tuning), bytes(smp.adsr))
+        
+    def add(self, sid, smp):
+        if not smp.brr:
+            return
+        bk = self.brr_key(smp)
+        fk = self.full_key(smp, bk)
+        if sid < self.exact.get(fk, sid + 1):
+            self.exact[fk] = sid
+        if sid > self.shadow.get(bk, sid - 1):
+            self.shadow[bk] = sid
+            
+    def find(self, smp):
+        # Returns (lowest id of an exact duplicate, highest id with the same BRR)
+        bk = self.brr_key(smp)
+        return self.exact.get(self.full_key(smp, bk)), self.shadow.get(bk)
+        
+## Parallel sequence loading (--jobs)
+def init_sequence_worker(worker_args, worker_edl):
+    global args, edl
+    args = worker_args
+    edl = worker_edl
+    
+def load_sequence(seq):
+    # Runs in a worker process. Console output is captured and returned with
+    # the sequence so the parent can print it in order, under the right song.
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        seq.load()
+    return seq, log.getvalue()
+    
+def load_sequences_parallel(sequence_defs, jobs):
+    ids = [id for id, seq in sequence_defs.items() if seq is not None]
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_sequence_worker, initargs=(args, edl)) as pool:
+        results = pool.map(load_sequence, [sequence_defs[id] for id in ids])
+        return dict(zip(ids, results))
+        
 def sanitize_path(in_path):
     drive, path = os.path.splitdrive(in_path)
     sep = os.path.sep if (path and path[0] in ['\\', '/']) else ""
@@ -362,6 +433,69 @@ def relpath(in_path):
     except ValueError:
         return p
         
+## Compiled MML cache
+# Opt-in (--cache DIR). Compiled sequences are stored as one json file per
+# combination of MML text, variant, sfx mode and compiler source, so any
+# change to the song or to mml2mfvi/mmltbl invalidates the entry. Each entry
+# also keeps the compiler's console output, so warnings are shown again when
+# it is reused; that output names the file, so the filename is keyed too.
+# Bump COMPILE_CACHE_FORMAT when the entry layout changes.
+COMPILE_CACHE_FORMAT = 2
+
+def get_compiler_version():
+    global compiler_version
+    if compiler_version is None:
+        h = hashlib.sha1()
+        srcdir = os.path.dirname(os.path.abspath(mml2mfvi.__file__))
+        for fn in [mml2mfvi.__file__, os.path.join(srcdir, "mmltbl.py")]:
+            try:
+                with open(fn, "rb") as f:
+                    h.update(f.read())
+            except OSError:
+                h.update(fn.encode("utf-8"))
+        compiler_version = h.hexdigest()
+    return compiler_version
+    
+def compile_cache_key(mml, variant, sfxmode, filename):
+    cache_dir = getattr(args, "cache_dir", None)
+    if not cache_dir:
+        return None
+    h = hashlib.sha1()
+    h.update(f"{COMPILE_CACHE_FORMAT}\0".encode("utf-8"))
+    h.update(get_compiler_version().encode("utf-8"))
+    h.update(f"\0{variant}\0{bool(sfxmode)}\0{isinstance(mml, str)}\0{filename}\0".encode("utf-8", "surrogateescape"))
+    h.update((mml if isinstance(mml, str) else "".join(mml)).encode("utf-8", "surrogateescape"))
+    return os.path.join(cache_dir, h.hexdigest() + ".json")
+    
+def load_compile_cache(fn):
+    if not fn:
+        return None
+    try:
+        with open(fn, "r") as f:
+            entry = json.load(f)
+        imports = {int(k): v for k, v in entry["imports"].items()}
+        return (bytes.fromhex(entry["data"]), bytes.fromhex(entry["inst"]), imports, entry["edl"], str(entry["log"]))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        warning(f"CACHE: ignoring unreadable cache entry {fn}")
+        return None
+        
+def save_compile_cache(fn, result):
+    if not fn:
+        return
+    data, inst, imports, edl, log = result
+    entry = {"data": bytes(data).hex(), "inst": bytes(inst).hex(), "imports": imports, "edl": edl, "log": log}
+    # parallel workers compiling the same song write to their own temp files
+    tmpfn = fn + f".{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(tmpfn, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmpfn, fn)
+    except OSError:
+        warning(f"CACHE: couldn't write cache entry {fn}")
+        
 def from_rom_address(addr):
     # NOTE ROM offset 7E0000-7E7FFF and 7F000-7F7FFF are inaccessible.
     # This is not handled by this program and it will treat them like 7E8000, etc
@@ -379,6 +513,8 @@ def to_rom_address(addr):
     return addr
     
 def byte_insert(data, position, newdata, maxlength=0, end=0):
+    if isinstance(data, RomImage):
+        return data.write(position, newdata, maxlength=maxlength, end=end)
     while position > len(data):
         data += (b"\x00" * (position - len(data)))
     if end:
@@ -398,6 +534,40 @@ def int_insert(data, position, newdata, length, reversed=True):
     if not reversed: l.reverse()
     return byte_insert(data, position, bytes(l), length)
 
+class RomImage(bytearray):
+    # The output ROM. Writes are done in place (growing the image with zeroes
+    # when writing past the end) instead of rebuilding the whole ROM, and each
+    # one is recorded in write_log as (offset, length, description).
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.write_log = []
+        
+    def write(self, position, newdata, desc=None, maxlength=0, end=0):
+        if end:
+            maxlength = end - position + 1
+        if maxlength and len(newdata) > maxlength:
+            newdata = newdata[:maxlength]
+        if position > len(self):
+            self.extend(b"\x00" * (position - len(self)))
+        self[position:position+len(newdata)] = newdata
+        self.write_log.append((position, len(newdata), desc))
+        return self
+        
+    def write_int(self, position, value, length, desc=None, reversed=True):
+        return self.write(position, int_insert(b"", 0, value, length, reversed), desc)
+        
+    def mirror_exhirom(self):
+        # Switch header to ExHiROM mapping and mirror bank 40 from bank 00
+        if len(self) > 0x400000 and self[0xFFD5] == 0x31:
+            self.write(0xFFD5, b"\x35", "ExHiROM map mode")
+            self.write(0xFFD7, b"\x0D", "ExHiROM ROM size")
+            self.write(0x400000, self[0x0000:0xFFFF], "ExHiROM bank 00 mirror")
+            return True
+        return False
+        
+    def repr_write_log(self):
+        return "\n".join(f"  {o:06X}-{o+l-1:06X} (0x{l:X}) {d if d else ''}" for o, l, d in self.write_log)
+        
 def bytes_to_int(data, reversed=True):
     n = 0
     for i, d in enumerate(data):
@@ -407,42 +577,183 @@ def bytes_to_int(data, reversed=True):
             n = (n << (8 * i)) + d
     return n
     
-def put_somewhere(romdata, newdata, desc, f_silent=False, bank=None):
-    global freespace, spoiler
-    if freespace is None:
-        init_freespace()
-    success = False
-    if bank is not None:
-        min_start = bank * 0x10000
-        max_end = bank * 0x10000 + 0x10000
-    for i, (start, end) in enumerate(freespace):
-        if bank is not None:
-            if end < min_start or start > max_end:
+class FreeSpace():
+    # Free ROM ranges as sorted, non-overlapping (start, end) pairs with the end
+    # exclusive. Ranges are indexed by address (for claiming and coalescing)
+    # and by size (for best-fit), so lookups don't have to walk every range.
+    def __init__(self, ranges=()):
+        self.starts = []
+        self.ends = {}
+        self.by_size = []
+        for start, end in ranges:
+            self.add(start, end)
+            
+    def __iter__(self):
+        for start in self.starts:
+            yield (start, self.ends[start])
+            
+    def __len__(self):
+        return len(self.starts)
+        
+    def copy(self):
+        fs = FreeSpace()
+        fs.starts = list(self.starts)
+        fs.ends = dict(self.ends)
+        fs.by_size = list(self.by_size)
+        return fs
+        
+    def _insert(self, start, end):
+        if end <= start:
+            return
+        bisect.insort(self.starts, start)
+        self.ends[start] = end
+        bisect.insort(self.by_size, (end - start, start))
+        
+    def _remove(self, start):
+        end = self.ends.pop(start)
+        del self.starts[bisect.bisect_left(self.starts, start)]
+        del self.by_size[bisect.bisect_left(self.by_size, (end - start, start))]
+        return end
+        
+    def add(self, start, end):
+        # Mark start..end-1 free, merging with any range it touches
+        if end <= start:
+            return
+        i = bisect.bisect_left(self.starts, start)
+        if i > 0 and self.ends[self.starts[i-1]] >= start:
+            i -= 1
+            start = self.starts[i]
+            end = max(end, self._remove(start))
+        while i < len(self.starts) and self.starts[i] <= end:
+            end = max(end, self._remove(self.starts[i]))
+        self._insert(start, end)
+        
+    def claim(self, start, end):
+        # Mark start..end-1 used, splitting any range it overlaps
+        if end <= start:
+            return
+        i = max(bisect.bisect_right(self.starts, start) - 1, 0)
+        while i < len(self.starts) and self.starts[i] < end:
+            s = self.starts[i]
+            e = self.ends[s]
+            if e <= start:
+                i += 1
                 continue
-            start = max(start, min_start)
-            bank_end = min(end, max_end)
-            room = bank_end - start
+            self._remove(s)
+            self._insert(s, start)
+            self._insert(end, e)
+            i = bisect.bisect_left(self.starts, start)
+            
+    def _fit(self, start, end, length, bank, align):
+        if bank is not None:
+            start = max(start, bank * 0x10000)
+            end = min(end, bank * 0x10000 + 0x10000)
+        if align > 1:
+            start += -start % align
+        return start if start + length <= end else None
+        
+    def find(self, length, bank=None, align=1, policy="first"):
+        # Returns the address where length bytes would be placed, or None
+        if bank is not None:
+            lo = max(bisect.bisect_right(self.starts, bank * 0x10000) - 1, 0)
+            hi = bisect.bisect_left(self.starts, bank * 0x10000 + 0x10000)
+            candidates = ((s, self.ends[s]) for s in self.starts[lo:hi])
+        elif policy == "best":
+            candidates = ((s, s + size) for size, s in self.by_size[bisect.bisect_left(self.by_size, (length, -1)):])
         else:
+            candidates = iter(self)
+        best, best_room = None, None
+        for start, end in candidates:
+            loc = self._fit(start, end, length, bank, align)
+            if loc is None:
+                continue
+            if policy != "best":
+                return loc
             room = end - start
-        if room < len(newdata):
-            continue
-        else:
-            romdata = byte_insert(romdata, start, newdata)
-            freespace[i] = (start + len(newdata), end)
-            if 'ROM Map' not in spoiler: spoiler['ROM Map'] = []
-            spoiler['ROM Map'].append("  0x{:x} -- {}".format(start, desc))
-            success= True
-            break
-    if not success:
+            if best is None or room < best_room:
+                best, best_room = loc, room
+                if bank is None:
+                    # by_size is ascending, so nothing later can fit tighter
+                    break
+        return best
+        
+    def allocate(self, length, bank=None, align=1, policy="first"):
+        loc = self.find(length, bank=bank, align=align, policy=policy)
+        if loc is not None:
+            self.claim(loc, loc + length)
+        return loc
+        
+    def total(self):
+        return sum(size for size, _ in self.by_size)
+        
+    def largest(self):
+        return self.by_size[-1][0] if self.by_size else 0
+        
+    def fragmentation(self):
+        # 0 when all free space is one contiguous block, approaching 1 as it
+        # is split into many small pieces
+        total = self.total()
+        return 1 - self.largest() / total if total else 0
+        
+    def report(self):
+        return (f"0x{self.total():X} bytes free in {len(self)} blocks, "
+                f"largest 0x{self.largest():X} (fragmentation {self.fragmentation():.0%})")
+                
+def put_somewhere(romdata, newdata, desc, f_silent=False, bank=None, align=1):
+    global freespace, spoiler
+    if freespace is None:
+        init_freespace()
+    policy = getattr(args, "fit", None) or "first"
+    start = freespace.allocate(len(newdata), bank=bank, align=align, policy=policy)
+    if start is None:
         if not f_silent:
             warning("ERROR: not enough free space to insert {}\n\n".format(desc))
         raise FreeSpaceError
-    return (romdata, start, end)
+    return put_at(romdata, start, newdata, desc)
+    
+def put_at(romdata, start, newdata, desc):
+    # Write data to a location already taken out of free space
+    if isinstance(romdata, RomImage):
+        romdata.write(start, newdata, desc)
+    else:
+        romdata = byte_insert(romdata, start, newdata)
+    if 'ROM Map' not in spoiler: spoiler['ROM Map'] = []
+    spoiler['ROM Map'].append("  0x{:x} -- {}".format(start, desc))
+    return (romdata, start, start + len(newdata))
+    
+def plan_placement(blobs, policy=None):
+    # Decide where everything in blobs, a list of (key, length, bank), goes
+    # before anything is written. Returns {key: location}, or None if it can't
+    # all fit. Blobs are first placed in the given order, which is what older
+    # versions did one at a time; if that runs out of room (or if policy is
+    # "pack"), they're packed largest-first, bank restricted ones first, each
+    # into the smallest block that fits.
+    global freespace
+    if freespace is None:
+        init_freespace()
+    policy = policy or getattr(args, "fit", None) or "first"
+    attempts = []
+    if policy != "pack":
+        attempts.append((blobs, policy))
+    attempts.append((sorted(blobs, key=lambda b: (b[2] is None, -b[1])), "best"))
+    for order, fit in attempts:
+        fs = freespace.copy()
+        plan = {}
+        for key, length, bank in order:
+            loc = fs.allocate(length, bank=bank, policy=fit)
+            if loc is None:
+                ifprint(f"DEBUG: {fit}-fit placement failed at {key} (0x{length:X} bytes)", DEBUG)
+                break
+            plan[key] = loc
+        else:
+            freespace = fs
+            return plan
+    return None
             
 def init_freespace():
     global freespace
     fs = CONFIG.get('DEFAULT', 'free_rom_space').split()
-    freespace = []
+    freespace = FreeSpace()
     while not freespace:
         for t in fs:
             if '-' not in t: continue
@@ -451,10 +762,11 @@ def init_freespace():
             except ValueError:
                 continue
             if start >= end: continue
-            freespace.append((start, end))
+            freespace.add(start, end)
         if not freespace:
             #to_default('free_rom_space')
             CONFIG['DEFAULT']['free_rom_space'] = "300000-3FFFFF"
+            fs = CONFIG.get('DEFAULT', 'free_rom_space').split()
             continue
         break
 
@@ -462,48 +774,24 @@ def free_space(start, end):
     global freespace
     if freespace is None:
         init_freespace()
-    freespace.append((start, end))
-    
-    newfs = []
-    for i, (start, end) in enumerate(sorted(freespace)):
-        if newfs:
-            laststart, lastend = newfs[-1][0], newfs[-1][1]
-            if start <= lastend + 1:
-                newfs[-1] = (laststart, max(end, lastend))
-            else:
-                newfs.append((start, end))
-        else:
-            newfs.append((start, end))
-    freespace = newfs
+    freespace.add(start, end)
+
+def space_available(length, bank=None):
+    if freespace is None:
+        init_freespace()
+    return freespace.find(length, bank=bank) is not None
 
 def claim_space(startc, endc):
-    global freespace
     if freespace is None: return
-    if startc > endc: return
-    newfs = []
-    for i, (start, end) in enumerate(sorted(freespace)):
-        if startc <= start and endc >= end:
-            pass
-        elif startc <= start and endc >= start:
-            newstart = endc+1
-            if newstart < end:
-                newfs.append((newstart, end))
-        elif startc <= end and endc >= end:
-            newend = startc-1
-            if newend > start:
-                newfs.append((start, newend))
-        elif startc >= start and endc <= end:
-            newend = startc-1
-            newstart = endc+1
-            if newend > start:
-                newfs.append((start, newend))
-            if newstart > end:
-                newfs.append((newstart, end))
-        else:
-            newfs.append((start, end))
-    freespace = newfs
+    freespace.claim(startc, endc + 1)
+    
+def report_freespace():
+    if freespace is None: return
+    inform(f"Remaining free space: {freespace.report()}")
+    ifprint(f"DEBUG: Free blocks: {repr_freespace()}", DEBUG)
     
 def repr_freespace():
+    if freespace is None: return ""
     text = ""
     for f in freespace:
         text += f"{f[0]:06X} - {f[1]:06X} (0x{f[1]-f[0]:X}), "
@@ -521,7 +809,7 @@ def load_edl_hack(outrom):
     hook = b"\x5C" + to_rom_address(hack_address).to_bytes(3, "little")
     hook_address = 0x501A4
     
-    outrom = byte_insert(outrom, hook_address, hook)
+    outrom.write(hook_address, hook, "EDL Table Hack hook")
     
     inform(f"Myria's EDL Table hack: code is at {hack_address:06X}, table is at {edl_table_address:06X}")
     
@@ -534,21 +822,21 @@ def load_shadow_hack(outrom):
     
     if hackmode == "safeshadow":
         # Dummy out E3 and F5 commands in shadow command switch
-        outrom = byte_insert(outrom, 0x50B06, b"\xEB")
-        outrom = byte_insert(outrom, 0x50B0F, b"\xEB")
+        outrom.write(0x50B06, b"\xEB", "safe shadow hack")
+        outrom.write(0x50B0F, b"\xEB", "safe shadow hack")
         inform(f"Safer shadow hack loaded.")
     elif hackmode == "ffmode":
         # Disable E3 and F5 shadowing after E2 is shadowed
         hackblob = b"\x78\xFF\xC5\xF0\x19\x68\xE2\xD0\x03\x8F\xFF\xC5\x68\xE3\xD0\x05\x3F\x25\x17\x2F\xD4\x68\xF5\xD0\x05\x3F\x95\x16\x2F\xCB\x68\xE5\xD0\x05\x3F\xCF\x15\x2F\xC2\x68\xE7\xD0\x0B\x3F\xF3\x15\x2F\xB9\x00\x00\x00\x00\x00\x00"
-        outrom = byte_insert(outrom, 0x50B05, hackblob)
+        outrom.write(0x50B05, hackblob, "shadow safe mode hack")
         inform(f"Shadow safe mode hack loaded.")
     elif hackmode == "noshadow":
         # Dummy out entire shadow command switch
-        outrom = byte_insert(outrom, spcprg_rel_offset + 0x05D4, b"\6F")
+        outrom.write(spcprg_rel_offset + 0x05D4, b"\6F", "no shadowing hack")
         # Add disable slur to jump table
-        outrom = byte_insert(outrom, spcprg_rel_offset + 0x18C3, b"\xCF\x15")
+        outrom.write(spcprg_rel_offset + 0x18C3, b"\xCF\x15", "no shadowing hack")
         # Add disable roll to jump table
-        outrom = byte_insert(outrom, spcprg_rel_offset + 0x18C7, b"\xDE\x15")
+        outrom.write(spcprg_rel_offset + 0x18C7, b"\xDE\x15", "no shadowing hack")
         inform(f"No shadowing hack loaded (unsafe??)")
         
     return outrom
@@ -566,8 +854,8 @@ def remap_brr(outrom, newloc):
     if original1 != original2:
         warning(f"WARNING: remap-BRR: Original ROM's SPC sample memory offsets don't match ({original1:04X} / {original2:04X}). This may mean that a hack was applied to your ROM that isn't compatible with remap-BRR. If so, expect corruption and/or game freezes.")
     newbytes = newloc.to_bytes(2, "little")
-    outrom = byte_insert(outrom, offset1, newbytes)
-    outrom = byte_insert(outrom, offset2, newbytes)
+    outrom.write(offset1, newbytes, "remap-BRR sample memory offset")
+    outrom.write(offset2, newbytes, "remap-BRR sample memory offset")
     
     ## Adjust SFX BRR pointers
     o_ptrblock = 0x52018
@@ -576,7 +864,7 @@ def remap_brr(outrom, newloc):
     for i in range(0x10):
         ptr = int.from_bytes(ptrblock[i*2:i*2+2], "little") - original1 + newloc
         new_ptrblock.extend(ptr.to_bytes(2, "little"))
-    outrom = byte_insert(outrom, o_ptrblock, new_ptrblock)
+    outrom.write(o_ptrblock, new_ptrblock, "remap-BRR SFX sample pointers")
     
     inform(f"SPC sample memory remapped to {newloc:04X}")
     return outrom
@@ -589,7 +877,7 @@ def max_blocks(edl):
         brr_ram_size += 0x4800 - remapbrr
     return brr_ram_size // 9
     
-def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None, freespace=None, brrpath=None, validate_only=False, quiet=False):
+def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None, freespace=None, brrpath=None, validate_only=False, quiet=False, cache_dir=None, jobs=None):
     global args
     global remapbrr
     
@@ -621,11 +909,18 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
         args.brrcount = "0x3F"
         args.brrpath = "samples"
         args.seqpath = ""
+        args.cache_dir = None
+        args.jobs = 1
+        args.fit = "first"
         
         purge_original_samples = True
         
     if brrpath:
         args.brrpath = brrpath
+    if cache_dir:
+        args.cache_dir = cache_dir
+    if jobs:
+        args.jobs = jobs
     args.seqpath = sanitize_path(args.seqpath)
     args.brrpath = sanitize_path(args.brrpath)
     
@@ -660,7 +955,7 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
     else:
         inform("found unheadered ROM.")
         
-    outrom = bytearray(inrom)
+    outrom = RomImage(inrom)
     
     # Set up data points in input ROM
     loc = offsets["bgmptrs"]
@@ -849,11 +1144,20 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
             sequence_defs[id].init_from_bin(fn)
         
     # Parse all MMLs / load all sequences
+    jobs = getattr(args, "jobs", None) or 1
+    loaded = None
+    if jobs > 1 and len(sequence_defs) > 1:
+        loaded = load_sequences_parallel(sequence_defs, jobs)
     for id, seq in sequence_defs.items():
         if seq is None:
             warning(f"DEBUG: Warning: Sequence {id} undefined")
             continue
-        seq.load()
+        if loaded:
+            seq, log = loaded[id]
+            sequence_defs[id] = seq
+            print(log, end="")
+        else:
+            seq.load()
         if seq.filetype:
             varitext = f" ({seq.variant})" if seq.variant else ""
             inform(f"{id:02X}: Loaded {relpath(seq.filename)}{varitext} as {seq.filetype}")
@@ -862,34 +1166,36 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
     # - Arrange sample files from MML into free ids
     # - Update sequence inst tables based on final sample id layout
     sampleid_queue = [id for id in range(1,256) if id not in sample_defs]
+    sample_index = SampleIndex(sample_defs)
+    loaded_imports = {}
     for id, seq in sequence_defs.items():
         if seq is None:
             continue
         if seq.imports:
             for k, v in seq.imports.items():
-                imported = Sample()
-                imported.init_from_import(v, basepath=os.path.dirname(seq.filename))
-                imported.load()
+                # Song packs often import the same file many times; only read it once
+                basepath = os.path.dirname(seq.filename)
+                import_key = (basepath, tuple(v))
+                if import_key not in loaded_imports:
+                    imported = Sample()
+                    imported.init_from_import(v, basepath=basepath)
+                    imported.load()
+                    loaded_imports[import_key] = imported
+                imported = copy(loaded_imports[import_key])
                 if not imported.brr:
                     continue
                 
-                this_sampleid = None
-                is_duplicate = False
-                for sid, smp in sorted(sample_defs.items()):
-                    if imported.brr == smp.brr:
-                        if imported.loop == smp.loop and imported.tuning == smp.tuning and imported.adsr == smp.adsr:
-                            inform(f"BRR-FROM-MML: Note: {relpath(seq.filename)} prg0x{k:02X} duplicates existing sample {sid:02X}")
-                            this_sampleid = sid
-                            break
-                        else:
-                            is_duplicate = True
-                            imported.internalid = sid
-                if is_duplicate and not this_sampleid:
-                    inform(f"BRR-FROM-MML: Note: {relpath(seq.filename)} prg0x{k:02X} duplicates existing sample {sid:02X} (metadata differs, shadowing in new ID)")
+                this_sampleid, shadow_sampleid = sample_index.find(imported)
+                if this_sampleid is not None:
+                    inform(f"BRR-FROM-MML: Note: {relpath(seq.filename)} prg0x{k:02X} duplicates existing sample {this_sampleid:02X}")
+                elif shadow_sampleid is not None:
+                    imported.internalid = shadow_sampleid
+                    inform(f"BRR-FROM-MML: Note: {relpath(seq.filename)} prg0x{k:02X} duplicates existing sample {shadow_sampleid:02X} (metadata differs, shadowing in new ID)")
                 if this_sampleid is None:
                     if sampleid_queue:
                         this_sampleid = sampleid_queue.pop(0)
                         sample_defs[this_sampleid] = imported
+                        sample_index.add(this_sampleid, imported)
                     elif imported.internalid is None:
                         warning(f"ERROR: Couldn't insert sample {imported.filename}, no IDs left!")
                         raise SampleIDError
@@ -996,7 +1302,8 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
         if sample_loc is not None:
             claim_space(sample_loc, sample_loc + brrblock_length - 1)
             
-    # Relocate bgm / brr / inst tables
+    # Collect data to be placed in free space
+    blobs = []
     o_brrtable = offsets['brrtable']
     o_bgmtable = offsets['bgmtable']
     o_insttable = offsets['insttable']
@@ -1008,10 +1315,7 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
         brrtable = inrom[o_brrtable : o_brrtable + (brrcount) * 3] + expansion * 3
         
         if brrtable_loc is None:
-            ifprint(f"RELOCATION: Free space before inserting 0x{len(brrtable):X} bytes BRR: {repr_freespace()}", DEBUG)
-            try:
-                outrom, o_brrtable, e = put_somewhere(outrom, brrtable, "BRR sample pointer table", bank=5)
-            except FreeSpaceError:
+            if not space_available(len(brrtable), bank=5):
                 if not expand_bgm:
                     inform(f"Relocating inst table to make room for BRR pointers..")
                     expand_bgm = True
@@ -1019,25 +1323,13 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
                     free_space(o, o + bgmcount * 3)
                     o = offsets['insttable']
                     free_space(o, o + bgmcount * 0x20)
-                    try:
-                        outrom, o_brrtable, e = put_somewhere(outrom, brrtable, "BRR sample pointer table", bank=5)
-                    except FreeSpaceError:
-                        warning(f"FATAL ERROR: Not enough free space in bank 5 for BRR pointers.")
-                        clean_end()
-                else:
+                if not space_available(len(brrtable), bank=5):
                     warning(f"FATAL ERROR: Not enough free space in bank 5 for BRR pointers.")
                     clean_end()
-            ifprint(f"RELOCATION: New BRR sample pointer table is at 0x{o_brrtable:06X}", VERBOSE)
+            blobs.append(("brrtable", len(brrtable), 5))
         else:
-            outrom = byte_insert(outrom, brrtable_loc, brrtable)
-            o_brrtable = brrtable_loc
             claim_space(brrtable_loc, brrtable_loc + len(brrtable))
             
-        o = offsets['brrptrs']
-        outrom = int_insert(outrom, o, to_rom_address(o_brrtable), 3)
-        outrom = int_insert(outrom, o+6, to_rom_address(o_brrtable+1), 3)
-        outrom = int_insert(outrom, o+12, to_rom_address(o_brrtable+2), 3)    
-        
     if bgmtable_loc or expand_bgm:
         if len(sequence_defs):
             new_bgmcount = max(bgmcount, max(sequence_defs.keys()) + 1)
@@ -1047,38 +1339,86 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
         expansion = b"\x00" * (new_bgmcount - bgmcount)
         bgmtable = inrom[o_bgmtable : o_bgmtable + bgmcount * 3] + expansion * 3
         insttable = inrom[o_insttable : o_insttable + bgmcount * 0x20] + expansion * 0x20
+        if bgmtable_loc is None:
+            blobs.append(("bgmtable", len(bgmtable), None))
+        else:
+            claim_space(bgmtable_loc, bgmtable_loc + len(bgmtable))
+        if inst_loc is None:
+            blobs.append(("insttable", len(insttable), None))
+        else:
+            claim_space(inst_loc, inst_loc + len(insttable))
+            
+    if (meta_loc or move_metadata) and meta_loc is None:
+        blobs.append(("looptable", len(looptable), None))
+        blobs.append(("pitchtable", len(pitchtable), None))
+        blobs.append(("adsrtable", len(adsrtable), None))
+    shared_brr = {}
+    if sample_loc is None:
+        # Identical BRR data is only placed once, whichever ids it's used by
+        placed_brr = {}
+        for id, smp in sample_defs.items():
+            if smp.brr and not smp.internalid:
+                key = SampleIndex.brr_key(smp)
+                if key in placed_brr:
+                    shared_brr[id] = placed_brr[key]
+                    continue
+                placed_brr[key] = id
+                blobs.append((("brr", id), len(smp.brr), None))
+    if sequence_loc is None:
+        for id, seq in sequence_defs.items():
+            if seq.sequence:
+                blobs.append((("seq", id), len(seq.sequence), None))
+                
+    # Decide where everything goes before writing any of it
+    ifprint(f"RELOCATION: Free space before placing {len(blobs)} items: {repr_freespace()}", DEBUG)
+    plan = plan_placement(blobs)
+    if plan is None:
+        warning(f"ERROR: not enough free space to insert 0x{sum(b[1] for b in blobs):X} bytes of data\n\n")
+        raise FreeSpaceError
         
+    # Write relocated tables
+    if brrtable_loc or expand_brr:
+        if brrtable_loc is None:
+            outrom, o_brrtable, e = put_at(outrom, plan["brrtable"], brrtable, "BRR sample pointer table")
+            ifprint(f"RELOCATION: New BRR sample pointer table is at 0x{o_brrtable:06X}", VERBOSE)
+        else:
+            outrom.write(brrtable_loc, brrtable, "BRR sample pointer table")
+            o_brrtable = brrtable_loc
+            
+        o = offsets['brrptrs']
+        outrom.write_int(o, to_rom_address(o_brrtable), 3, "BRR sample pointer table pointer")
+        outrom.write_int(o+6, to_rom_address(o_brrtable+1), 3, "BRR sample pointer table pointer")
+        outrom.write_int(o+12, to_rom_address(o_brrtable+2), 3, "BRR sample pointer table pointer")
+        
+    if bgmtable_loc or expand_bgm:
         if bgmtable_loc is None:
-            ifprint(f"RELOCATION: Free space before inserting 0x{len(bgmtable):X} bytes BGM: {repr_freespace()}", DEBUG)
-            outrom, o_bgmtable, e = put_somewhere(outrom, bgmtable, "BGM sequence pointer table")
+            outrom, o_bgmtable, e = put_at(outrom, plan["bgmtable"], bgmtable, "BGM sequence pointer table")
             ifprint(f"RELOCATION: New BGM sequence pointer table is at 0x{o_bgmtable:06X}", VERBOSE)
         else:
-            outrom = byte_insert(outrom, bgmtable_loc, bgmtable)
+            outrom.write(bgmtable_loc, bgmtable, "BGM sequence pointer table")
             o_bgmtable = bgmtable_loc
-            claim_space(bgmtable_loc, bgmtable_loc + len(bgmtable))
         if inst_loc is None:
-            outrom, o_insttable, e = put_somewhere(outrom, insttable, "BGM instrument loadout table")
+            outrom, o_insttable, e = put_at(outrom, plan["insttable"], insttable, "BGM instrument loadout table")
             ifprint(f"RELOCATION: New BGM instrument table is at 0x{o_insttable:06X}", VERBOSE)
         else:
-            outrom = byte_insert(outrom, inst_loc, insttable)
+            outrom.write(inst_loc, insttable, "BGM instrument loadout table")
             o_insttable = inst_loc
-            claim_space(inst_loc, inst_loc + len(insttable))
             
         o = offsets['bgmptrs']
-        outrom = int_insert(outrom, o, to_rom_address(o_bgmtable), 3)
-        outrom = int_insert(outrom, o+6, to_rom_address(o_bgmtable+1), 3)
-        outrom = int_insert(outrom, o+12, to_rom_address(o_bgmtable+2), 3)
+        outrom.write_int(o, to_rom_address(o_bgmtable), 3, "BGM sequence pointer table pointer")
+        outrom.write_int(o+6, to_rom_address(o_bgmtable+1), 3, "BGM sequence pointer table pointer")
+        outrom.write_int(o+12, to_rom_address(o_bgmtable+2), 3, "BGM sequence pointer table pointer")
         o = offsets['instptr']
-        outrom = int_insert(outrom, o, to_rom_address(o_insttable), 3)
+        outrom.write_int(o, to_rom_address(o_insttable), 3, "BGM instrument table pointer")
         o = offsets['bgmcount']
-        outrom = int_insert(outrom, o, new_bgmcount, 1)
+        outrom.write_int(o, new_bgmcount, 1, "BGM count")
         
     # Insert metadata
     if meta_loc or move_metadata:
         if meta_loc is None:
-            outrom, o_looptable, e = put_somewhere(outrom, looptable, "BRR instrument loop table")
-            outrom, o_pitchtable, e = put_somewhere(outrom, pitchtable, "BRR instrument pitch table")
-            outrom, o_adsrtable, e = put_somewhere(outrom, adsrtable, "BRR instrument ADSR table")
+            outrom, o_looptable, e = put_at(outrom, plan["looptable"], looptable, "BRR instrument loop table")
+            outrom, o_pitchtable, e = put_at(outrom, plan["pitchtable"], pitchtable, "BRR instrument pitch table")
+            outrom, o_adsrtable, e = put_at(outrom, plan["adsrtable"], adsrtable, "BRR instrument ADSR table")
         else:
             if args.pack_metadata:
                 metablock = looptable + pitchtable + adsrtable
@@ -1093,22 +1433,25 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
                 o_looptable = meta_loc + 0x2
                 o_pitchtable = meta_loc + 0x202
                 o_adsrtable = meta_loc + 0x402
-            outrom = byte_insert(outrom, meta_loc, metablock)
+            outrom.write(meta_loc, metablock, "BRR instrument metadata")
             
         inform(f"METADATA: Output ROM table locations: loop {o_looptable:06X}, tuning {o_pitchtable:06X}, envelope {o_adsrtable:06X}")
         for metapointer, metatable in [('loopptr', o_looptable), ('pitchptr', o_pitchtable), ('adsrptr', o_adsrtable)]:
             loc = offsets[metapointer]
-            outrom = byte_insert(outrom, loc, to_rom_address(metatable).to_bytes(3, 'little'))
+            outrom.write(loc, to_rom_address(metatable).to_bytes(3, 'little'), f"BRR instrument {metapointer}")
             
     # Insert BRRs and update BRR pointers
     for id, smp in sample_defs.items():
         if smp.internalid or not smp.brr:
             continue
-        if sample_loc is None:
-            outrom, s, e = put_somewhere(outrom, smp.brr, f"brr {id:02X}: {smp.filename}")
+        if id in shared_brr:
+            s = sample_defs[shared_brr[id]].data_location
+            inform(f"Sample {relpath(smp.filename)} is identical to sample {shared_brr[id]:02X}, sharing its data at ${s:06X}")
+        elif sample_loc is None:
+            outrom, s, e = put_at(outrom, plan[("brr", id)], smp.brr, f"brr {id:02X}: {smp.filename}")
             inform(f"Inserted sample {relpath(smp.filename)} (0x{len(smp.brr):X} bytes | {len(smp.brr)//9} blocks) at ${s:06X}")
         else:
-            outrom = byte_insert(outrom, sample_loc, smp.brr)
+            outrom.write(sample_loc, smp.brr, f"brr {id:02X}: {smp.filename}")
             s = sample_loc
             inform(f"Inserted sample {relpath(smp.filename)} (0x{len(smp.brr):X} bytes) at ${s:06X}")
             sample_loc += len(smp.brr)
@@ -1120,7 +1463,7 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
                     smp.data_location = sample_defs[smp.internalid].data_location
         if smp.data_location:
             loc = o_brrtable + (id-1) * 3
-            outrom = byte_insert(outrom, loc, to_rom_address(smp.data_location).to_bytes(3, "little"))
+            outrom.write(loc, to_rom_address(smp.data_location).to_bytes(3, "little"), f"brr {id:02X} pointer")
         else:
             warning(f"Error: no sample data location for sample {id} ({smp.filename})")
     
@@ -1166,10 +1509,10 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
         
         # Write seq data
         if sequence_loc is None:
-            outrom, s, e = put_somewhere(outrom, seq.sequence, f"seq {id:02X}: {seq.filename}")
+            outrom, s, e = put_at(outrom, plan[("seq", id)], seq.sequence, f"seq {id:02X}: {seq.filename}")
             seqtext = f"Inserted sequence {relpath(seq.filename)} (0x{len(seq.sequence):X} bytes) at ${s:06X}"
         else:
-            outrom = byte_insert(outrom, sequence_loc, seq.sequence)
+            outrom.write(sequence_loc, seq.sequence, f"seq {id:02X}: {seq.filename}")
             s = sequence_loc
             seqtext = f"Inserted sequence {relpath(seq.filename)} at ${s:06X}"
             sequence_loc += len(seq.sequence)
@@ -1186,12 +1529,12 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
         
         # Write seq pointer
         loc = o_bgmtable + id * 3
-        outrom = byte_insert(outrom, loc, to_rom_address(s).to_bytes(3, "little"))
+        outrom.write(loc, to_rom_address(s).to_bytes(3, "little"), f"seq {id:02X} pointer")
         ifprint(f"DEBUG: seq pointer {id:02X} is {to_rom_address(s).to_bytes(3, 'little').hex().upper()} at {loc:06X}", DEBUG)
         
         # Write inst table
         loc = o_insttable + id * 0x20
-        outrom = byte_insert(outrom, loc, seq.inst)
+        outrom.write(loc, seq.inst, f"seq {id:02X} instrument table")
         
         # Write EDL table if applicable
         if edl_table_address:
@@ -1200,24 +1543,26 @@ def insertmfvi(inrom, argparam=None, virt_sample_list=None, virt_seq_list=None,
     if validate_only:
         return validation_results
         
+    report_freespace()
+        
     # Reattach header and write ROM
     inform()
     if len(outrom) % 0x10000:
         outrom += b"\x00" * (0x10000 - (len(outrom) % 0x10000))
         
     if len(outrom) > 0x400000:
-        if outrom[0xFFD5] == 0x31:
-            outrom = byte_insert(outrom, 0xFFD5, b"\x35")
-            outrom = byte_insert(outrom, 0xFFD7, b"\x0D")
-            outrom = byte_insert(outrom, 0x400000, outrom[0x0000:0xFFFF])
+        if outrom.mirror_exhirom():
             warning(f"ROM mapping mode changed to ExHIROM")
     if len(outrom) != len(inrom):
         inform(f"ROM file size is now 0x{len(outrom):06X} bytes")
+    if DEBUG:
+        print(f"DEBUG: ROM writes:\n{outrom.repr_write_log()}")
     outrom = romheader + outrom
     
     return outrom
     
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     print("mfvitools Music and Instrument Insertion Tool for Final Fantasy VI")
     print()
     
@@ -1243,6 +1588,7 @@ if __name__ == "__main__":
     outgroup.add_argument('-I', '--inst', help="set offset (hex) for instrument loading tables written to ROM", metavar="OFFSET", dest="o_inst")
     outgroup.add_argument('-c', '--pack_metadata', action="store_true", help="use the minimum possible amount of space for instrument metadata")
     outgroup.add_argument('-P', '--pad_samples', action="store_true", help="fill gaps in sample IDs with dummy data")
+    outgroup.add_argument('--fit', choices=["first", "best", "pack"], default="first", help="choose how data is placed into free space: lowest address that fits, smallest free block that fits, or largest items first into the smallest blocks that fit. first and best also fall back to pack if data doesn't fit otherwise. (default: %(default)s)")
     outgroup.add_argument('--quiet', action="store_true", help="disable informational console output, leaving only warnings and errors")
     hackgroup.add_argument('-e', '--edl', help="set echo delay length in output ROM (affects all game audio)")
     hackgroup.add_argument('-H', '--hack', help="add Myria's EDL ASM hack", action='store_true')
@@ -1252,6 +1598,8 @@ if __name__ == "__main__":
     filegroup.add_argument('-s', '--brrpath', default="", help="define base path for samples loaded from import list files")
     filegroup.add_argument('-p', '--seqpath', default="", help="define base path for sequences loaded from import list files")
     filegroup.add_argument('-d', '--dump-brr', action="store_true", help="dump all samples in final ROM and create a list file for them")
+    filegroup.add_argument('-j', '--jobs', type=int, default=1, help="compile sequences using this many processes (default: %(default)s)", metavar="N")
+    filegroup.add_argument('--cache', help="keep compiled MML in this directory and reuse it for unchanged songs on later runs", metavar="DIRECTORY", dest="cache_dir")
     
     def print_no_file_selected_help():
         print("No actions selected!")
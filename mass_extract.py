@@ -2,8 +2,9 @@
 ## extract mml, samples, and SPC from multiple tracks all at once, with tags
 ## set up what to extract in a config file, then run mass_extract.py [CONFIGFILE]
 
-import sys, os, configparser
-from build_spc import build_spc, load_data_from_rom, read_pointer
+import sys, os, io, json, hashlib, contextlib, configparser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from build_spc import SpcBuilder, load_data_from_rom, RomIndex, SPC_WORK_RAM_FILE, SPC_AUX_RAM_FILE
 from mfvi2mml import akao_to_mml, byte_insert
 
 SPC_ENGINE_OFFSET = 0x5070E
@@ -19,18 +20,216 @@ POINTER_TO_BRR_PITCH = 0x5049C
 POINTER_TO_INST_TABLE = 0x501E3
 POINTER_TO_SEQ_POINTERS = 0x50539
 
+# Records what each output was extracted from, so unchanged songs can be
+# skipped when extracting again
+MANIFEST_FILE = "mass_extract.json"
+
 def text_insert(data, position, text, length):
     new_data = bytearray(length)
     new_data = byte_insert(new_data, 0, bytes(text, "utf-8"), maxlength = length)
     return bytearray(byte_insert(data, position, new_data))
     
+def parse_meta(meta_string):
+    # [file, title, game, composer, arranger]
+    meta_cfg = [m.strip() for m in meta_string.split(';')]
+    while len(meta_cfg) < 5:
+        meta_cfg.append("")
+    return meta_cfg
+    
+def brr_filename(romid, brr_data):
+    brr_ident = f"{len(brr_data) // 9:04}_{sum(brr_data) % pow(16,6):06X}"
+    return f"brr/{romid}/{brr_ident}.brr"
+    
+# Outputs are only reusable if they were made by the same code
+def extract_version():
+    h = hashlib.sha1()
+    import build_spc, mfvi2mml, mfvidisasm, mmltbl
+    for module in (__file__, build_spc.__file__, mfvi2mml.__file__, mfvidisasm.__file__, mmltbl.__file__):
+        with open(module, "rb") as f:
+            h.update(f.read())
+    for fn in (SPC_WORK_RAM_FILE, SPC_AUX_RAM_FILE):
+        try:
+            with open(fn, "rb") as f:
+                h.update(f.read())
+        except OSError:
+            pass
+    return h.hexdigest()
+    
+def rom_inputs_hash(index):
+    # Data shared by every song's SPC: engine, SFX and static samples
+    rom = index.rom
+    h = hashlib.sha1()
+    for loc in (index.spc_engine_offset, index.sfx_seq_offset, index.static_brr_offset,
+                index.static_ptr_offset, index.static_env_offset, index.static_pitch_offset):
+        h.update(load_data_from_rom(rom, loc))
+    return h.hexdigest()
+    
+def song_inputs_hash(index, song_idx, meta_string, common_hash):
+    h = hashlib.sha1(common_hash.encode())
+    h.update(meta_string.encode())
+    h.update(index.sequence(song_idx))
+    h.update(index.inst_table(song_idx))
+    for inst_id in index.instruments(song_idx):
+        if inst_id:
+            sample = index.sample(inst_id)
+            h.update(sample.brr + sample.loop + sample.env + sample.pitch)
+    return h.hexdigest()
+    
+def load_manifest(fn=MANIFEST_FILE):
+    try:
+        with open(fn, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != extract_version():
+        return {}
+    return manifest.get("songs", {})
+    
+def save_manifest(songs, fn=MANIFEST_FILE):
+    tmpfn = fn + f".{os.getpid()}.tmp"
+    try:
+        with open(tmpfn, "w") as f:
+            json.dump({"version": extract_version(), "songs": songs}, f, indent=1, sort_keys=True)
+        os.replace(tmpfn, fn)
+    except OSError:
+        print(f"ERROR: couldn't write {fn}")
+        
+def write_samples(index, romid, song_ids):
+    # Write each distinct sample used by these songs once. Files that already
+    # hold the same data are left alone.
+    written, kept = 0, 0
+    for inst_id in sorted({i for song_idx in song_ids for i in index.instruments(song_idx) if i}):
+        brr_data = index.sample(inst_id).brr
+        bfn = brr_filename(romid, brr_data)
+        try:
+            with open(bfn, "rb") as f:
+                if f.read() == brr_data:
+                    kept += 1
+                    continue
+        except OSError:
+            pass
+        os.makedirs(os.path.dirname(bfn), exist_ok = True)
+        try:
+            with open(bfn, "wb") as f:
+                f.write(brr_data)
+            written += 1
+        except IOError:
+            print(f"ERROR: Couldn't write sample {romid}:{inst_id:02X} as {bfn}")
+    return written, kept
+    
+## Each worker process keeps its own SPC builder (and index) for the ROM
+## currently being extracted
+
+worker_builder = None
+
+def init_worker(rom):
+    global worker_builder
+    worker_builder = SpcBuilder(rom)
+    
+def extract_song(romid, song_idx, meta_string):
+    # Build the SPC and MML for one song and write them out. Console output
+    # is collected and returned so parallel songs don't interleave.
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        ok = _extract_song(worker_builder, romid, song_idx, meta_string)
+    return ok, log.getvalue()
+    
+def _extract_song(builder, romid, song_idx, meta_string):
+    index, rom = builder.index, builder.rom
+    spc = builder.build(song_idx)
+    
+    ## Build MML
+    # Extract sequence from ROM and convert to MML
+    loc = index.sequence_offset(song_idx)
+    seq = load_data_from_rom(rom, loc)
+    try:
+        mml = akao_to_mml(seq, force_short_header=True)
+    except IndexError:
+        print(f"Failed to convert sequence {romid}:{song_idx:02X} (sequence too short?)")
+        return False
+        
+    # Samples are written separately by write_samples; here we only need
+    # their definitions
+    sample_defs = []
+    for i, inst_id in enumerate(index.instruments(song_idx)):
+        if inst_id:
+            sample = index.sample(inst_id)
+            brr_loop = int.from_bytes(sample.loop, "big")
+            brr_env = int.from_bytes(sample.env, "big")
+            brr_pitch = int.from_bytes(sample.pitch, "big")
+            bfn = brr_filename(romid, sample.brr)
+            
+            # Build definition
+            prg = i + 0x20
+            sample_defs.append(f"#BRR 0x{prg:02X} 0x{inst_id:02X}; {bfn}, {brr_loop:04X}, {brr_pitch:04X}, {brr_env:04X}")
+            
+    out_mml = []
+    
+    ## Deal with metadata
+    meta_cfg = parse_meta(meta_string)
+    songfn = romid + '_' + meta_cfg[0]
+    
+    if meta_cfg[1]:
+        out_mml.append(f"#TITLE {meta_cfg[1]}")
+        spc = text_insert(spc, 0x2E, meta_cfg[1], 0x20)
+        spc[0x23] = 0x1A
+    if meta_cfg[2]:
+        out_mml.append(f"#ALBUM {meta_cfg[2]}")
+        spc = text_insert(spc, 0x4E, meta_cfg[2], 0x20)
+        spc[0x23] = 0x1A
+    if meta_cfg[3]:
+        out_mml.append(f"#COMPOSER {meta_cfg[3]}")
+        spc = text_insert(spc, 0xB1, meta_cfg[3], 0x20)
+        spc[0x23] = 0x1A
+    if meta_cfg[4]:
+        out_mml.append(f"#ARRANGED {meta_cfg[4]}")
+        spc = text_insert(spc, 0x6E, meta_cfg[4], 0x10)
+        spc[0x23] = 0x1A
+    spc = byte_insert(spc, 0xAC, b"\x35\x30\x30\x30")
+    
+    ## MML surgery
+    out_mml.append("")
+    for line in sample_defs:
+        out_mml.append(line)
+    out_mml.append("")
+    
+    mml = [line for line in mml if not line.startswith("#WAVE")]
+    out_mml = out_mml + mml
+    out_mml = "\n".join(out_mml)
+    
+    ## file output
+    ok = True
+    this_fn = songfn + ".spc"
+    try:
+        with open(this_fn, "wb") as f:
+            f.write(spc)
+    except IOError:
+        print(f"ERROR: failed to write {this_fn}")
+        ok = False
+        
+    this_fn = songfn + ".mml"
+    try:
+        with open(this_fn, "w") as f:
+            f.write(out_mml)
+    except IOError:
+        print(f"ERROR: failed to write {this_fn}")
+        ok = False
+    return ok
+    
 if __name__ == "__main__":
     print(f"mfvitools mass extractor tool")
     print(f"                    created by emberling")
     print()
     
-    if len(sys.argv) >= 2:
-        fn = sys.argv[1]
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", nargs="?", help="config file, or a ROM to extract all music from")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes to extract with (default: one per CPU)")
+    parser.add_argument("-f", "--force", action="store_true", help=f"extract every song again, even if {MANIFEST_FILE} says it is unchanged")
+    args = parser.parse_args()
+    
+    if args.config:
+        fn = args.config
     else:
         print("HOW TO USE:")
         print("Make a config file to set up the files you want to extract.     ")
@@ -76,6 +275,8 @@ if __name__ == "__main__":
     else:
         config.read(fn)
     
+    manifest = {} if args.force else load_manifest()
+    
     for romfile in config.sections():
         
         romid = os.path.basename(romfile).split('.')[0].strip().replace(' ', '_')
@@ -91,123 +292,46 @@ if __name__ == "__main__":
             print(f"Loaded {romfile} with header.")
         else:
             print(f"Loaded {romfile} without header.")
-            
+        index = RomIndex(rom)
+        common_hash = rom_inputs_hash(index)
+        
+        # (song_idx, meta string, manifest key, inputs hash)
+        songs = []
         for song_idx_string in config[romfile]:
             try:
                 song_idx = int(song_idx_string.strip(), 16)
             except ValueError:
                 print(f"ERROR: invalid index {song_idx_string}")
                 continue
-                
-            spc = build_spc(rom, song_idx)
-            
-            ## Build MML
-            brr_pointer_offset = read_pointer(rom, POINTER_TO_BRR_POINTERS)
-            brr_loop_offset = read_pointer(rom, POINTER_TO_BRR_LOOPS)
-            brr_env_offset = read_pointer(rom, POINTER_TO_BRR_ENV)
-            brr_pitch_offset = read_pointer(rom, POINTER_TO_BRR_PITCH)
-            inst_table_offset = read_pointer(rom, POINTER_TO_INST_TABLE)
-            
-            # Extract sequence from ROM and convert to MML
-            loc = read_pointer(rom, POINTER_TO_SEQ_POINTERS)
-            loc += song_idx * 3
-            loc = read_pointer(rom, loc)
-            seq = load_data_from_rom(rom, loc)
-            try:
-                mml = akao_to_mml(seq, force_short_header=True)
-            except IndexError:
-                print(f"Failed to convert sequence {romid}:{song_idx:02X} (sequence too short?)")
+            meta_string = config[romfile][song_idx_string]
+            songfn = romid + '_' + parse_meta(meta_string)[0]
+            inputs = song_inputs_hash(index, song_idx, meta_string, common_hash)
+            if (manifest.get(songfn) == inputs and os.path.exists(songfn + ".spc")
+                    and os.path.exists(songfn + ".mml")):
+                print(f"{romid}:{song_idx:02X} unchanged, skipping {songfn}")
                 continue
-                
-            # Extract samples from ROM
-            #brr_loop, brr_env, brr_pitch, brr_ident = {}, {}, {}, {}
-            sample_defs = []
-            loc = song_idx * 0x20 + inst_table_offset
-            inst_table = rom[loc:loc+0x20]
-            for i in range(16):
-                inst_id = int.from_bytes(inst_table[i*2:i*2+2], "little")
-                if inst_id:
-                    inst_idx = inst_id - 1
-                    loc = brr_loop_offset + 2 * inst_idx
-                    brr_loop = int.from_bytes(rom[loc:loc+2], "big")
-                    
-                    loc = brr_env_offset + 2 * inst_idx
-                    brr_env = int.from_bytes(rom[loc:loc+2], "big")
-                    
-                    loc = brr_pitch_offset + 2 * inst_idx
-                    brr_pitch = int.from_bytes(rom[loc:loc+2], "big")
-                    
-                    brr_pointer = read_pointer(rom, brr_pointer_offset + 3 * inst_idx)
-                    brr_data = load_data_from_rom(rom, brr_pointer)
-                    
-                    brr_ident = f"{len(brr_data) // 9:04}_{sum(brr_data) % pow(16,6):06X}"
-                    
-                    os.makedirs(os.path.join("brr", romid), exist_ok = True)
-                    bfn = f"brr/{romid}/{brr_ident}.brr"
-                    try:
-                        with open(bfn, "wb") as f:
-                            f.write(brr_data)
-                    except IOError:
-                        print(f"ERROR: Couldn't write sample {romid}:{song_idx:02X}:{i + 0x20:02X} as {bfn}")
-                        continue
-                    
-                    # Build definition
-                    prg = i + 0x20
-                    sample_defs.append(f"#BRR 0x{prg:02X} 0x{inst_id:02X}; {bfn}, {brr_loop:04X}, {brr_pitch:04X}, {brr_env:04X}")
-                    
-            out_mml = []
-            
-            ## Deal with metadata
-            meta_cfg = config[romfile][song_idx_string].split(';')
-            while len(meta_cfg) < 5:
-                meta_cfg.append("")
-            for i in range(len(meta_cfg)):
-                meta_cfg[i] = meta_cfg[i].strip()
-                
-            songfn = romid + '_' + meta_cfg[0]
-            
-            if meta_cfg[1]:
-                out_mml.append(f"#TITLE {meta_cfg[1]}")
-                spc = text_insert(spc, 0x2E, meta_cfg[1], 0x20)
-                spc[0x23] = 0x1A
-            if meta_cfg[2]:
-                out_mml.append(f"#ALBUM {meta_cfg[2]}")
-                spc = text_insert(spc, 0x4E, meta_cfg[2], 0x20)
-                spc[0x23] = 0x1A
-            if meta_cfg[3]:
-                out_mml.append(f"#COMPOSER {meta_cfg[3]}")
-                spc = text_insert(spc, 0xB1, meta_cfg[3], 0x20)
-                spc[0x23] = 0x1A
-            if meta_cfg[4]:
-                out_mml.append(f"#ARRANGED {meta_cfg[4]}")
-                spc = text_insert(spc, 0x6E, meta_cfg[4], 0x10)
-                spc[0x23] = 0x1A
-            spc = byte_insert(spc, 0xAC, b"\x35\x30\x30\x30")
-            
-            ## MML surgery
-            out_mml.append("")
-            for line in sample_defs:
-                out_mml.append(line)
-            out_mml.append("")
-            
-            mml = [line for line in mml if not line.startswith("#WAVE")]
-            out_mml = out_mml + mml
-            out_mml = "\n".join(out_mml)
+            songs.append((song_idx, meta_string, songfn, inputs))
             
-            ## file output
+        written, kept = write_samples(index, romid, [song[0] for song in songs])
+        print(f"{romid}: {len(songs)} songs to extract; wrote {written} samples, {kept} already up to date")
+        if not songs:
+            continue
             
-            this_fn = songfn + ".spc"
-            try:
-                with open(this_fn, "wb") as f:
-                    f.write(spc)
-            except IOError:
-                print("ERROR: failed to write {this_fn}")
+        def report(song, ok, log):
+            print(log, end="")
+            song_idx, meta_string, songfn, inputs = song
+            if ok:
+                manifest[songfn] = inputs
+            else:
+                manifest.pop(songfn, None)
+            save_manifest(manifest)
                 
-            this_fn = songfn + ".mml"
-            try:
-                with open(this_fn, "w") as f:
-                    f.write(out_mml)
-            except IOError:
-                print("ERROR: failed to write {this_fn}")
-                
-            
\ No newline at end of file
+        if args.jobs == 1:
+            init_worker(rom)
+            for song in songs:
+                report(song, *extract_song(romid, song[0], song[1]))
+        else:
+            with ProcessPoolExecutor(args.jobs, initializer=init_worker, initargs=(rom,)) as pool:
+                futures = {pool.submit(extract_song, romid, song[0], song[1]): song for song in songs}
+                for future in as_completed(futures):
+                    report(futures[future], *future.result())
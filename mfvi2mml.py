@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
-import sys, traceback
+import sys, os, io, time, glob, contextlib, traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import mfvitbl
 from mmltbl import *
+from mfvidisasm import disassemble
 
 jump_bytes = [0xF5, 0xF6, 0xFC]
 
@@ -24,6 +26,9 @@ def int_insert(data, position, newdata, length, reversed=True):
     if not reversed: l.reverse()
     return byte_insert(data, position, bytes(l), length)
 
+# MML text for each note byte
+note_text = [mfvitbl.notes[int(b//14)].lower() + r_length_tbl[b%14] for b in range(0xC4)]
+
 def warn(fileid, cmd, msg):
     print(f"{fileid}: WARNING: in {cmd:<10}: {msg}")
 
@@ -73,7 +78,7 @@ def akao_to_mml(data, inst=None, fileid='akao', force_short_header=False):
     #don't get treated as active channels
     end_addr = unskew(data[4] + (data[5] << 8))
     
-    channels, r_channels = {}, {}
+    channels, channel_starts = {}, {}
     for c in range(0,16):
         caddr = unskew(data[6 + c*2] + (data[7 + c*2] << 8))
         if c >= 8:
@@ -81,83 +86,65 @@ def akao_to_mml(data, inst=None, fileid='akao', force_short_header=False):
                 continue
         channels[c] = caddr
     for k, v in channels.items():
-        r_channels[v] = k
+        channel_starts.setdefault(v, []).append(k)
         
-    #some padding so we don't read beyond end of data
-    data += b"\x00\x00\x00"
+    dis = disassemble(data, long_header=True)
     
-    loc = 0x26
     jumps = {}
     nextjump = 1
-    while loc < len(data)-3:
-        byte = data[loc]
-        if byte in [0xF5, 0xF6, 0xFC]:
-            jloc = loc+2 if byte == 0xF5 else loc+1
-            target = unskew(data[jloc] + (data[jloc+1] << 8))
-            jumps[target] = nextjump
+    for ins in dis.instructions:
+        if ins.opcode in [0xF5, 0xF6, 0xFC]:
+            jumps[ins.target] = nextjump
             nextjump += 1
-        bytelen = 1
-        if byte in byte_tbl: bytelen += byte_tbl[byte][0]
-        loc += bytelen
     for j, i in jumps.items():
         print("jump id {} is at {}".format(i, hex(j)))
     
-    loc = 0x26
+    # Output is collected as a list of fragments per MML line and joined
+    # when the line is finished
     measure = 0
     sinceline = 0
-    line = ""
-    foundjumps = []
-    while loc < len(data)-3:
-        byte = data[loc]
-        bytelen = 1
+    line = []
+    foundjumps = set()
+    for ins in dis.instructions:
+        loc = ins.offset
+        byte = ins.opcode
         # IF channel points here
-        if loc in r_channels:
-            for chnl in [c for c in channels if channels[c] == loc]:
+        if loc in channel_starts:
+            for chnl in channel_starts[loc]:
                 if loc >= end_addr:
                     print(f"Ignoring channel pointer {chnl+1} (0x{loc:04X}) - past stated EOF (0x{end_addr:04X})")
                 else:
-                    line += "\n{%d}\nl16" % (chnl+1)
+                    line.append("\n{%d}\nl16" % (chnl+1))
         # IF jump points here
         if loc in jumps:
-            line += " $%d " % jumps[loc]
-            foundjumps.append(jumps[loc])
+            line.append(" $%d " % jumps[loc])
+            foundjumps.add(jumps[loc])
         # IF this is a jump
         if byte in jump_bytes:
-            paramlen = byte_tbl[byte][0]
             s = byte_tbl[byte][1]
             params = []
             late_add_param = None
             if byte == 0xF5:
-                params.append(data[loc+1])
-                tloc = loc + 2
-            else: tloc = loc + 1
-            dest = unskew(data[tloc] + (data[tloc+1] << 8))
-            bytelen += paramlen
+                params.append(ins.params[0])
+            dest = ins.target
             if dest in jumps:
                 params.append(jumps[dest])
             else:
                 params.append("{N/A}")
                 warncmd = ""
-                for d in data[loc:loc+bytelen]:
+                for d in data[loc:ins.next]:
                     warncmd += f"{d:2X} "
                 warn(fileid, warncmd, f"Error parsing jump to {dest:X}")
                 print(jumps)
-            while params:
-                s += str(params.pop(0))
-                if params:
-                    s += ","
-            line += s
+            line.append(s + ",".join(str(p) for p in params))
             if byte in [0xEB, 0xF6]: #segment enders
-                line += "\n\nl16"
+                line.append("\n\nl16")
             else:
-                line += " "
+                line.append(" ")
         #
         elif byte in byte_tbl:
-            paramlen = byte_tbl[byte][0]
             s = byte_tbl[byte][1]
-            params = []
-            for p in range(1,paramlen+1):
-                params.append(data[loc+p])
+            params = list(ins.params)
             while params:
                 if byte == 0xDC:
                     if params[0] >= 32 and params[0] < 48:
@@ -174,25 +161,21 @@ def akao_to_mml(data, inst=None, fileid='akao', force_short_header=False):
                             params[0] = 256 - params[0]
                         else:
                             s += "+"
-            line += s
+            line.append(s)
             if byte in [0xEB, 0xF6]: #segment enders
-                line += "\n\nl16"
-            bytelen += paramlen
+                line.append("\n\nl16")
         elif byte <= 0xC3:
-            note = mfvitbl.notes[int(byte//14)].lower()
-            length = r_length_tbl[byte%14]
-            line += note + length
+            line.append(note_text[byte])
             measure += mfvitbl.lengths[byte%14]
             if measure >= 0xC0:
-                line += "  "
+                line.append("  ")
                 sinceline += measure
                 measure = 0
-                if sinceline >= 0xC0 * 4 or len(line) >= 64:
-                    mml.append(line)
-                    line = ""
+                if sinceline >= 0xC0 * 4 or sum(map(len, line)) >= 64:
+                    mml.append("".join(line))
+                    line = []
                     sinceline = 0
-        loc += bytelen
-    mml.append(line)
+    mml.append("".join(line))
     
     # If main start exists but alternate does not exist for a channel pair,
     # set up alternate starts at EOF
@@ -208,11 +191,158 @@ def akao_to_mml(data, inst=None, fileid='akao', force_short_header=False):
             warn(fileid, "{} {}".format(k,v), "Jump destination never found")
     return mml
     
+## batch mode
+
+def find_sequences(patterns):
+    # Expand files, directories and glob patterns into (data, inst) filename
+    # pairs. *_data.bin is paired with the *_inst.bin next to it, if any;
+    # *_inst.bin files are never converted on their own.
+    found = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, "*_data.bin"))
+        else:
+            matches = glob.glob(pattern)
+            if not matches and os.path.exists(pattern + "_data.bin"):
+                matches = [pattern + "_data.bin"]
+        found.extend(fn for fn in matches if os.path.isfile(fn) and not fn.endswith("_inst.bin"))
+    
+    sequences = []
+    for fn in sorted(set(found)):
+        inst_fn = None
+        if fn.endswith("_data.bin") and os.path.isfile(fn[:-9] + "_inst.bin"):
+            inst_fn = fn[:-9] + "_inst.bin"
+        sequences.append((fn, inst_fn))
+    return sequences
+    
+def output_base(data_fn):
+    # Same naming as single-file mode: foo_data.bin -> foo.mml, foo -> foo.mml
+    return data_fn[:-9] if data_fn.endswith("_data.bin") else data_fn
+    
+def output_names(sequences, outdir=None):
+    # MML filename for each sequence. With an output directory, each file
+    # keeps its path relative to the directory all the inputs share, so
+    # a/song_data.bin and b/song_data.bin don't both become DIR/song.mml.
+    bases = [os.path.abspath(output_base(data_fn)) for data_fn, _ in sequences]
+    if outdir and bases:
+        root = os.path.commonpath([os.path.dirname(b) for b in bases])
+        bases = [os.path.join(outdir, os.path.relpath(b, root)) for b in bases]
+    return [b + ".mml" for b in bases]
+    
+def find_collisions(sequences, outputs):
+    # {output filename: [input filenames]} for outputs written by more than one input
+    claims = {}
+    for (data_fn, _), out_fn in zip(sequences, outputs):
+        claims.setdefault(os.path.normcase(out_fn), []).append(data_fn)
+    return {out_fn: fns for out_fn, fns in claims.items() if len(fns) > 1}
+    
+def convert_file(data_fn, inst_fn=None, out_fn=None):
+    # Convert one sequence file to MML. Returns a dict describing the result;
+    # the converter's console output is collected in "log" rather than printed
+    # so output from parallel conversions doesn't interleave.
+    base = output_base(data_fn)
+    if out_fn is None:
+        out_fn = base + ".mml"
+    result = {"file": data_fn, "out": out_fn, "lines": 0, "warnings": 0, "time": 0.0, "error": None}
+    
+    log = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with open(data_fn, 'rb') as df:
+            data = df.read()
+        inst = None
+        if inst_fn:
+            with open(inst_fn, 'rb') as instf:
+                inst = instf.read()
+        with contextlib.redirect_stdout(log):
+            mml = akao_to_mml(data, inst, fileid=os.path.basename(base))
+        os.makedirs(os.path.dirname(os.path.abspath(out_fn)), exist_ok=True)
+        with open(out_fn, 'w') as mf:
+            for line in mml:
+                mf.write(line + "\n")
+        result["lines"] = len(mml)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        log.write(traceback.format_exc())
+    result["time"] = time.perf_counter() - start
+    result["log"] = log.getvalue()
+    result["warnings"] = result["log"].count("WARNING")
+    return result
+    
+def convert_batch(sequences, jobs=None, outdir=None, verbose=False):
+    # Convert a list of (data, inst) filename pairs in a process pool.
+    # Each result is reported as soon as its file has been written. Raises
+    # ValueError, before anything is converted, if two inputs would be
+    # written to the same MML file.
+    outputs = output_names(sequences, outdir)
+    collisions = find_collisions(sequences, outputs)
+    if collisions:
+        raise ValueError("more than one input would be written to the same file:\n" + "\n".join(
+                f"  {out_fn} <- {', '.join(fns)}" for out_fn, fns in sorted(collisions.items())))
+    results = []
+    
+    def report(result):
+        results.append(result)
+        status = "FAILED" if result["error"] else "OK"
+        print(f"[{len(results):>{len(str(len(sequences)))}}/{len(sequences)}] {status:6} {result['file']}")
+        if verbose or result["error"]:
+            for line in result["log"].splitlines():
+                print("    " + line)
+                
+    if jobs == 1:
+        for (data_fn, inst_fn), out_fn in zip(sequences, outputs):
+            report(convert_file(data_fn, inst_fn, out_fn))
+    else:
+        with ProcessPoolExecutor(jobs) as pool:
+            futures = [pool.submit(convert_file, data_fn, inst_fn, out_fn)
+                       for (data_fn, inst_fn), out_fn in zip(sequences, outputs)]
+            for future in as_completed(futures):
+                report(future.result())
+    return sorted(results, key=lambda r: r["file"])
+    
+def print_summary(results, elapsed):
+    width = max([len(r["file"]) for r in results] + [4])
+    print()
+    print(f"{'file':<{width}}  {'lines':>6}  {'warn':>4}  {'time':>8}  status")
+    for r in results:
+        status = r["error"] if r["error"] else "ok"
+        print(f"{r['file']:<{width}}  {r['lines']:>6}  {r['warnings']:>4}  {r['time']*1000:>6.0f}ms  {status}")
+    failed = sum(1 for r in results if r["error"])
+    cpu = sum(r["time"] for r in results)
+    print()
+    print(f"{len(results) - failed} converted, {failed} failed, {sum(r['warnings'] for r in results)} warnings")
+    print(f"{elapsed:.2f}s elapsed ({cpu:.2f}s total conversion time)")
+    
 if __name__ == "__main__":
     
     print("mfvitools AKAO SNESv4 to MML converter")
     print()
     
+    # Batch mode: any options, several files, a directory, or a glob pattern
+    if len(sys.argv) > 2 or (len(sys.argv) == 2 and (os.path.isdir(sys.argv[1])
+            or glob.has_magic(sys.argv[1]) or sys.argv[1].startswith("-"))):
+        import argparse
+        parser = argparse.ArgumentParser(description="Convert AKAO sequences to MML. "
+                "Directories are searched for *_data.bin files, which are paired with their *_inst.bin.")
+        parser.add_argument("paths", nargs="+", help="sequence files, directories, or glob patterns")
+        parser.add_argument("-o", "--outdir", help="write MML files to this directory (default: next to each input)")
+        parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes to convert with (default: one per CPU)")
+        parser.add_argument("-v", "--verbose", action="store_true", help="show converter output for every file, not only failures")
+        args = parser.parse_args()
+        
+        sequences = find_sequences(args.paths)
+        if not sequences:
+            print("No sequence files found")
+            sys.exit(1)
+        start = time.perf_counter()
+        try:
+            results = convert_batch(sequences, jobs=args.jobs, outdir=args.outdir, verbose=args.verbose)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        print_summary(results, time.perf_counter() - start)
+        sys.exit(1 if any(r["error"] for r in results) else 0)
+        
     if len(sys.argv) >= 2:
         fn = sys.argv[1]
     else:
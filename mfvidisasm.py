@@ -0,0 +1,181 @@
+# MFVIDISASM - shared disassembler for AKAO4 (FF6) binary sequences
+#
+# Decodes a sequence once into a list of instructions and a control-flow
+# graph, for use by tools that would otherwise each walk the bytecode and
+# look up command lengths themselves. Results are cached by sequence hash,
+# so disassembling the same song again (from another tool, or another pass
+# of the same tool) is free.
+
+import hashlib
+from collections import namedtuple
+
+try:
+    from mmltbl import byte_tbl
+except ImportError:
+    from .mmltbl import byte_tbl
+
+LOOP_START = 0xE2
+LOOP_END = 0xE3
+VOLTA = 0xF5
+JUMP = 0xF6
+COND_JUMP = 0xFC
+JUMP_CODES = [VOLTA, JUMP, COND_JUMP]
+END_CODES = [0xEB, 0xEC, 0xED, 0xEE, 0xEF, 0xFD, 0xFE, 0xFF]
+
+# Number of parameter bytes following each opcode. Notes (00-C3) and unknown
+# codes have none.
+param_lengths = [0] * 0x100
+for code, (length, _) in byte_tbl.items():
+    param_lengths[code] = length
+
+class Instruction(namedtuple("Instruction", "offset opcode params target")):
+    # offset: index of the opcode in the sequence data
+    # params: parameter bytes (zero-padded if the data ends early)
+    # target: for jumps, index of the destination in the sequence data
+    __slots__ = ()
+
+    @property
+    def next(self):
+        return self.offset + 1 + len(self.params)
+
+    @property
+    def is_note(self):
+        return self.opcode < 0xC4
+
+class Disassembly():
+    def __init__(self, data, long_header=False):
+        # long_header: data begins with the 2-byte length used in ROM storage
+        self.data = bytes(data)
+        self.header_length = 0x26 if long_header else 0x24
+        hpos = 2 if long_header else 0
+        self.addr_base = int.from_bytes(self.data[hpos:hpos+2], "little")
+        self.addr_end = self.addr(int.from_bytes(self.data[hpos+2:hpos+4], "little"))
+        self.channels = [self.addr(int.from_bytes(self.data[hpos+4+c*2:hpos+6+c*2], "little"))
+                         for c in range(16)]
+
+        self._decoded = {}
+        self._successors = {}
+        self._blocks = None
+
+        # Linear sweep over the whole sequence. Control flow that lands in
+        # the middle of an instruction from this sweep still works through
+        # at(), which decodes any offset on request.
+        self.instructions = []
+        self.jumps = {}
+        self.loops = {}
+        loop_stack = []
+        loc = self.header_length
+        end = len(self.data)
+        decode, decoded, instructions = self._decode, self._decoded, self.instructions
+        while loc < end:
+            ins = decode(loc)
+            decoded[loc] = ins
+            instructions.append(ins)
+            opcode = ins.opcode
+            loc += 1 + len(ins.params)
+            if opcode < LOOP_START:
+                continue
+            if ins.target is not None:
+                self.jumps[ins.offset] = ins.target
+            elif opcode == LOOP_START:
+                loop_stack.append(loc)
+            elif opcode == LOOP_END and loop_stack:
+                self.loops[ins.offset] = loop_stack.pop()
+        self.labels = sorted(set(self.jumps.values()))
+
+    def addr(self, address):
+        # Convert a raw SPC address to the equivalent index in data
+        address -= self.addr_base
+        if address < 0:
+            address += 0x10000
+        return address + self.header_length
+
+    def at(self, offset):
+        # Instruction starting at offset. Raises IndexError past the end of data.
+        ins = self._decoded.get(offset)
+        if ins is None:
+            ins = self._decoded[offset] = self._decode(offset)
+        return ins
+
+    def _decode(self, offset):
+        opcode = self.data[offset]
+        plen = param_lengths[opcode]
+        if not plen:
+            return Instruction(offset, opcode, b"", None)
+        params = self.data[offset+1:offset+1+plen]
+        if len(params) < plen:
+            params += bytes(plen - len(params))
+        target = None
+        if opcode == VOLTA:
+            target = self.addr(int.from_bytes(params[1:3], "little"))
+        elif opcode in JUMP_CODES:
+            target = self.addr(int.from_bytes(params[0:2], "little"))
+        return Instruction(offset, opcode, params, target)
+
+    def successors(self, offset):
+        # Offsets control can pass to after the instruction at offset.
+        # Loop ends can go back to the start of their loop body or fall
+        # through; voltas and conditional jumps can jump or fall through.
+        if offset in self._successors:
+            return self._successors[offset]
+        ins = self.at(offset)
+        if ins.opcode in END_CODES:
+            succ = ()
+        elif ins.opcode == JUMP:
+            succ = (ins.target,)
+        elif ins.opcode in JUMP_CODES:
+            succ = (ins.next, ins.target)
+        elif ins.opcode == LOOP_END and offset in self.loops:
+            succ = (ins.next, self.loops[offset])
+        else:
+            succ = (ins.next,)
+        self._successors[offset] = succ
+        return succ
+
+    def blocks(self):
+        # Basic blocks reachable from the channel start points, as
+        # {start offset: (list of instructions, successor block starts)}
+        if self._blocks is not None:
+            return self._blocks
+        starts = [c for c in self.channels if c < len(self.data)]
+        leaders = set(starts)
+        seen = set()
+        queue = list(starts)
+        while queue:
+            loc = queue.pop()
+            while loc not in seen and loc < len(self.data):
+                seen.add(loc)
+                succ = self.successors(loc)
+                if len(succ) != 1 or succ[0] != self.at(loc).next:
+                    leaders.update(s for s in succ)
+                    queue.extend(succ)
+                    break
+                loc = succ[0]
+        self._blocks = {}
+        for start in sorted(leaders):
+            if start >= len(self.data):
+                continue
+            body = []
+            loc = start
+            while True:
+                ins = self.at(loc)
+                body.append(ins)
+                succ = self.successors(loc)
+                if len(succ) != 1 or succ[0] != ins.next or succ[0] in leaders or succ[0] >= len(self.data):
+                    break
+                loc = succ[0]
+            self._blocks[start] = (body, [s for s in succ if s < len(self.data)])
+        return self._blocks
+
+_cache = {}
+MAX_CACHED = 256
+
+def disassemble(data, long_header=False):
+    # Disassemble a sequence, reusing the result if these exact bytes have
+    # been disassembled before
+    key = (hashlib.sha1(data).digest(), long_header)
+    if key not in _cache:
+        if len(_cache) >= MAX_CACHED:
+            _cache.clear()
+        _cache[key] = Disassembly(data, long_header=long_header)
+    return _cache[key]
@@ -1,7 +1,14 @@
+import bisect, math, hashlib, json, csv, os, io, contextlib
+from concurrent.futures import ProcessPoolExecutor
+
 try:
     import mfvitbl
+    from mfvidisasm import disassemble
+    from build_spc import load_data_from_rom, read_pointer
 except ImportError:
     from . import mfvitbl
+    from .mfvidisasm import disassemble
+    from .build_spc import load_data_from_rom, read_pointer
 
 # Multiply total length by this amount to compensate for any slowdown, etc
 FUDGE_FACTOR = 1.005
@@ -20,6 +27,7 @@ class TrackState():
         self.loc = self.addr(start)
         self.stopped = False
         self.data = data
+        self.dis = disassemble(data)
         self.segment = 0
         self.ticks = 0
         self.delta = 0
@@ -38,6 +46,10 @@ class TrackState():
     def get_state(self):
         return (self.loc, self.stopped, self.delta, list(self.stack))
         
+    def get_state_key(self):
+        # Hashable version of get_state()
+        return (self.loc, self.stopped, self.delta, tuple(self.stack))
+        
     def tick(self):
         if not self.stopped:
             self.delta -= 1
@@ -46,6 +58,17 @@ class TrackState():
                 print("somehow, delta < 0")
             if self.delta == 0:
                 self.loc += 1
+                
+    def advance(self, ticks):
+        # Same as calling tick() this many times, for up to the rest of the
+        # current event's duration
+        if not self.stopped:
+            self.delta -= ticks
+            self.ticks += ticks
+            if self.delta < 0:
+                print("somehow, delta < 0")
+            if self.delta == 0:
+                self.loc += 1
             
     def addr(self, address):
         # Convert a raw address to the equivalent index in "data"
@@ -64,7 +87,8 @@ class TrackState():
         
         while True:
             loc = self.loc
-            bytecode = self.data[loc]
+            ins = self.dis.at(loc)
+            bytecode = ins.opcode
             if bytecode < 0xC4:
                 if not self.delta:
                     self.delta = mfvitbl.lengths[bytecode % 14]
@@ -72,15 +96,12 @@ class TrackState():
                 return tempo_changes
             #print(f"[{self.id}] {self.loc+0x1C02:04X} {bytecode:02X}")
             
-            cmdlen = 1
-            if bytecode in mfvitbl.codes:
-                cmdlen += mfvitbl.codes[bytecode][0]
-            next = loc + cmdlen
+            next = ins.next
         
             if bytecode == 0xE2:
                 # Loop start
                 count = 1
-                repeats = self.data[loc+1]
+                repeats = ins.params[0]
                 target = self.loc + 2
                 self.stack.append((count, repeats, target))
                 #print(f"[{self.id}] loop start")
@@ -106,21 +127,21 @@ class TrackState():
                 
             elif bytecode == 0xE8:
                 # Set next note duration
-                self.delta = self.data[loc+1]
+                self.delta = ins.params[0]
                 
             elif bytecode == 0xF0:
                 # Set tempo
-                tempo_changes[0] = self.data[loc+1]
+                tempo_changes[0] = ins.params[0]
                 
             elif bytecode == 0xF1:
                 # Tempo fade
-                tempo_changes[1] = self.data[loc+1]
-                tempo_changes[2] = self.data[loc+2]
+                tempo_changes[1] = ins.params[0]
+                tempo_changes[2] = ins.params[1]
                 
             elif bytecode == 0xF5 and self.stack:
                 # Loop break / volta
-                condition = self.data[loc+1]
-                vtarget = self.addr(int.from_bytes(self.data[loc+2:loc+4], "little"))
+                condition = ins.params[0]
+                vtarget = ins.target
                 count, repeats, ltarget = self.stack.pop()
                 if condition == count:
                     next = vtarget
@@ -133,7 +154,7 @@ class TrackState():
                 
             elif bytecode == 0xF6:
                 # Jump
-                target = self.addr(int.from_bytes(self.data[loc+1:loc+3], "little"))
+                target = ins.target
                 next = target
                 if VERBOSE:
                     print(f"[{self.id}] {self.loc+0x1C02:04X} jump to {target+0x1C02:04X}")
@@ -154,7 +175,8 @@ class TrackState():
         
             
 # Read an AKAO4 (FF6) binary sequence and return its approximate length in seconds
-def mfvi_trace(data, iterations=2, long_header=False):
+# With return_loop=True, returns (seconds, intro ticks, loop ticks, intro seconds)
+def mfvi_trace(data, iterations=2, long_header=False, return_loop=False):
     if long_header:
         data = data[2:]
     
@@ -163,7 +185,6 @@ def mfvi_trace(data, iterations=2, long_header=False):
     tracks = []
     tempo_sets = {}
     tempo_fades = {}
-    loop_ticks = {}
     loop_lengths = {}
     initial_segments = {}
     for trackid in range(8):
@@ -190,7 +211,6 @@ def mfvi_trace(data, iterations=2, long_header=False):
                 else:
                     segment = track.jump_records[track.last_new_jump][-1] - track.jump_records[track.last_new_jump][-2]
                 print(f"breaking track {track.id} at {ticks} with delta {segment} ({measure(segment)})")
-                loop_ticks[track.id] = segment
                 loop_lengths[track.id] = segment
                 initial_segments[track.id] = ticks - segment
                 break
@@ -201,24 +221,19 @@ def mfvi_trace(data, iterations=2, long_header=False):
             if tempo_cmds[2]:
                 tempo_fades[track.id][ticks] = (tempo_cmds[1], tempo_cmds[2])
                 
-            # Advance time
-            ticks += 1
-            track.tick()
+            # Advance time directly to the end of this event; nothing can
+            # happen on this track in between
+            step = max(1, min(track.delta, MAX_TICKS - ticks))
+            ticks += step
+            track.advance(step)
                     
     # Extend loops until everything is in phase
-    longest_ticks = max(loop_ticks.values())
-    while longest_ticks < MAX_TICKS:
-        shorter_track_found = False
-        for id in loop_ticks:
-            while 0 < loop_ticks[id] < longest_ticks:
-                loop_ticks[id] += loop_lengths[id]
-                longest_ticks = max(loop_ticks[id], longest_ticks)
-                shorter_track_found = True
-            print(f" {loop_ticks[id]:5}  ", end="")
-        print()
-        if not shorter_track_found:
-            print(longest_ticks)
-            break
+    longest_ticks = align_loops(loop_lengths.values())
+    if longest_ticks is None:
+        print(f"loops never realign within {MAX_TICKS} ticks")
+        longest_ticks = MAX_TICKS
+    else:
+        print(f"loops realign every {longest_ticks} ticks ({measure(longest_ticks)})")
     total_ticks = longest_ticks + max(initial_segments.values())
     print(f"{total_ticks=}")
     
@@ -228,30 +243,62 @@ def mfvi_trace(data, iterations=2, long_header=False):
     for id in tempo_sets:
         for tick, tempo in tempo_sets[id].items():
             tempo_timeline[tick] = (tempo, None, None)
-            if tick >= initial_segments[id]:
+            if tick >= initial_segments[id] and loop_lengths[id]:
                 vtick = tick + loop_lengths[id]
                 while vtick < total_ticks:
-                    tempo_timeline[tick] = (tempo, None, None)
+                    tempo_timeline[vtick] = (tempo, None, None)
                     vtick += loop_lengths[id]
     for id in tempo_fades:
         for tick, (dur, target) in tempo_fades[id].items():
             tempo = tempo_timeline[tick][0] if tick in tempo_timeline else None
             tempo_timeline[tick] = (tempo, dur, target)
-            if tick >= initial_segments[id]:
+            if tick >= initial_segments[id] and loop_lengths[id]:
                 vtick = tick + loop_lengths[id]
                 while vtick < total_ticks:
-                    tempo = tempo_timeline[tick][0] if tick in tempo_timeline else None
-                    tempo_timeline[tick] = (tempo, dur, target)
+                    tempo = tempo_timeline[vtick][0] if vtick in tempo_timeline else None
+                    tempo_timeline[vtick] = (tempo, dur, target)
                     vtick += loop_lengths[id]
-    for k in sorted(tempo_timeline):
+    timeline_ticks = sorted(tempo_timeline)
+    for k in timeline_ticks:
         print(f"{k:5}:: {tempo_timeline[k]}")
-            
+        
+    duration = integrate_tempo(tempo_timeline, total_ticks, timeline_ticks)
+    print(duration)
+    if return_loop:
+        intro_ticks = max(initial_segments.values())
+        intro_duration = integrate_tempo(tempo_timeline, intro_ticks, timeline_ticks)
+        return min(duration, 999), intro_ticks, longest_ticks, min(intro_duration, 999)
+    return min(duration, 999)
+    
+# Each looping track is back at the start of its loop every loop_length ticks
+# after its intro, so once the longest intro is over, all of them are back in
+# the same place together every LCM(loop lengths) ticks. Tracks with a loop
+# length of 0 have stopped and don't count. Returns that period, or None if
+# it's longer than max_ticks.
+def align_loops(loop_lengths, max_ticks=MAX_TICKS):
+    period = 0
+    for length in loop_lengths:
+        if length > 0:
+            period = length * period // math.gcd(length, period) if period else length
+            if period > max_ticks:
+                return None
+    return period
+    
+# Total time in seconds of the first total_ticks ticks of a song, given its
+# tempo events as {tick: (tempo or None, fade duration, fade target or None)}.
+# Stretches of constant tempo are added up in one step, so this scales with
+# the number of tempo events. Fades can't be longer than 255 ticks, so those
+# are still stepped through tick by tick.
+def integrate_tempo(tempo_timeline, total_ticks, timeline_ticks=None):
+    if timeline_ticks is None:
+        timeline_ticks = sorted(tempo_timeline)
     tempo = 0
     tempo_increment = 0
     tick_length = 1.0
     tempo_target = None
     duration = 0.0
-    for ticks in range(total_ticks):
+    ticks = 0
+    while ticks < total_ticks:
         prev_tempo = tempo
         if tempo_target:
             tempo += tempo_increment
@@ -271,12 +318,26 @@ def mfvi_trace(data, iterations=2, long_header=False):
             bpm = 60000000.0 / (48 * (125 * 0x27)) * (tempo / 256.0)
             tick_length = 1 / (bpm * 48 / 60)
         duration += tick_length
-    print(duration)
-    return min(duration, 999)
+        ticks += 1
+        
+        # Skip ahead to the next tempo event if tempo is holding steady
+        if not tempo_target or not tempo_increment:
+            i = bisect.bisect_left(timeline_ticks, ticks)
+            next_event = timeline_ticks[i] if i < len(timeline_ticks) else total_ticks
+            steady = min(next_event, total_ticks) - ticks
+            if steady > 0:
+                duration += tick_length * steady
+                ticks += steady
+    return duration
             
 # Read an AKAO4 (FF6) binary sequence and return its approximate length in seconds
 # (the time it takes to reach an identical state for the nth time)     
-def _mfvi_trace(data, iterations=2, long_header=False):
+# With hashed=True, states are only recorded on ticks where some track starts
+# a new event or a tempo fade ends, or once every track has stopped (between
+# those, the state just counts down, so it can't close a loop without one of
+# them) and are looked up in a dict instead of a list. With return_loop=True, also returns the tick the
+# last detected loop started at and its length in ticks.
+def _mfvi_trace(data, iterations=2, long_header=False, hashed=True, return_loop=False):
     if long_header:
         data = data[2:]
     
@@ -293,6 +354,8 @@ def _mfvi_trace(data, iterations=2, long_header=False):
     song_length = 0
     prev_tempo = 0
     tick_length = 0
+    seen_states = {}
+    loop_start, loop_length = None, None
     for trackid in range(8):
         loc = 4 + trackid * 2
         addr = int.from_bytes(data[loc:loc+2], "little")
@@ -303,7 +366,11 @@ def _mfvi_trace(data, iterations=2, long_header=False):
             
     while tick < MAX_TICKS:
         # Advance each track until delta is nonzero
+        event_boundary = tick == 0
         for track in tracks:
+            if not track.stopped and not track.delta:
+                event_boundary = True
+            had_target = tempo_target
             tempo_changes = track.acquire_delta()
             
             # Handle tempo changes
@@ -322,17 +389,38 @@ def _mfvi_trace(data, iterations=2, long_header=False):
             if tempo_fade:
                 tempo_target = tempo_new_target
                 tempo_increment = (tempo_new_target - tempo) / tempo_fade
+            if had_target and not tempo_target:
+                event_boundary = True
+        # Once the song has ended, every tick has the same state, so it must
+        # be compared to close the loop
+        if not tempo_target and all(track.stopped for track in tracks):
+            event_boundary = True
             
         # Compare and record states once everything has a delta
-        state = [tempo, tempo_increment, tempo_target]
-        state += [track.get_state() for track in tracks]
-        if state in states:
-            loops_found += 1
-            if loops_found >= iterations:
-                print(tick_tempos)
-                break
-            states = []
-        if VERBOSE:
+        if hashed:
+            if event_boundary:
+                state = (tempo, tempo_increment, tempo_target) + tuple(track.get_state_key() for track in tracks)
+                if state in seen_states:
+                    loop_start = seen_states[state]
+                    loop_length = tick - loop_start
+                    loops_found += 1
+                    if loops_found >= iterations:
+                        print(tick_tempos)
+                        print(f"Loop starts at tick {loop_start} ({measure(loop_start)}), length {loop_length} ticks ({measure(loop_length)})")
+                        break
+                    seen_states = {}
+                seen_states[state] = tick
+        else:
+            state = [tempo, tempo_increment, tempo_target]
+            state += [track.get_state() for track in tracks]
+            if state in states:
+                loops_found += 1
+                if loops_found >= iterations:
+                    print(tick_tempos)
+                    break
+                states = []
+            states.append(state)
+        if VERBOSE and (event_boundary or not hashed):
             print(f"{tick} {state}")
         else:
             if tick % (192 * 32) == 0:
@@ -342,7 +430,6 @@ def _mfvi_trace(data, iterations=2, long_header=False):
             if tick % 192 == 0:
                 print(".", end="", flush=True)
         
-        states.append(state)
         tick += 1
         for track in tracks:
             track.tick()
@@ -373,14 +460,125 @@ def _mfvi_trace(data, iterations=2, long_header=False):
         song_length += tick_length * FUDGE_FACTOR
     print(f"Song length {int(song_length // 60)}:{round(song_length % 60):02} ({song_length} sec.)")
     
+    if return_loop:
+        return min(song_length, 999), loop_start, loop_length
     return min(song_length, 999)
         
+## Song length database for a whole ROM
+
+POINTER_TO_SEQ_POINTERS = 0x50539
+SONG_COUNT_OFFSET = 0x53C5E
+DATABASE_FIELDS = ["id", "hash", "intro_ticks", "loop_ticks", "intro_seconds", "loop_seconds", "total_seconds", "error"]
+
+# Returns {song id: sequence data} for every song in an FF6 ROM
+def rom_sequences(rom):
+    if len(rom) % 0x10000 == 0x200:
+        rom = rom[0x200:]
+    table = read_pointer(rom, POINTER_TO_SEQ_POINTERS)
+    sequences = {}
+    for song_idx in range(rom[SONG_COUNT_OFFSET]):
+        loc = read_pointer(rom, table + song_idx * 3)
+        sequences[song_idx] = load_data_from_rom(rom, loc, seq=True)
+    return sequences
+    
+# Cached results are only valid for the tracer that produced them, including
+# the disassembler and table it decodes with and the sequence loading helpers
+def trace_version():
+    h = hashlib.sha1()
+    srcdir = os.path.dirname(os.path.abspath(__file__))
+    for module in (__file__, mfvitbl.__file__, "mfvidisasm.py", "mmltbl.py", "build_spc.py"):
+        with open(os.path.join(srcdir, module), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+    
+def trace_entry(data):
+    # Runs in a worker process; tracer output is discarded
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds, intro_ticks, loop_ticks, intro_seconds = mfvi_trace(data, return_loop=True)
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    return {"intro_ticks": intro_ticks, "loop_ticks": loop_ticks,
+            "intro_seconds": round(intro_seconds, 3), "loop_seconds": round(seconds - intro_seconds, 3),
+            "total_seconds": round(seconds, 3)}
+            
+def load_trace_cache(fn):
+    try:
+        with open(fn, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("version") != trace_version():
+        return {}
+    return cache.get("songs", {})
+    
+def save_trace_cache(fn, songs):
+    tmpfn = fn + f".{os.getpid()}.tmp"
+    try:
+        with open(tmpfn, "w") as f:
+            json.dump({"version": trace_version(), "songs": songs}, f)
+        os.replace(tmpfn, fn)
+    except OSError:
+        print(f"WARNING: couldn't write trace cache {fn}")
+        
+# Trace every song in a ROM and return {song id: database entry}.
+# Songs whose sequence data is already in cache_file (keyed by a hash of the
+# data) aren't traced again.
+def song_length_database(rom, jobs=None, cache_file=None):
+    sequences = rom_sequences(rom)
+    hashes = {song_idx: hashlib.sha1(data).hexdigest() for song_idx, data in sequences.items()}
+    cache = load_trace_cache(cache_file) if cache_file else {}
+    
+    todo = {}
+    for song_idx, h in hashes.items():
+        if h not in cache and h not in todo:
+            todo[h] = sequences[song_idx]
+    if todo:
+        if jobs == 1:
+            results = map(trace_entry, todo.values())
+            cache.update(zip(todo.keys(), results))
+        else:
+            with ProcessPoolExecutor(jobs) as pool:
+                cache.update(zip(todo.keys(), pool.map(trace_entry, todo.values())))
+        if cache_file:
+            save_trace_cache(cache_file, cache)
+            
+    return {song_idx: {"id": f"{song_idx:02X}", "hash": h, **cache[h]} for song_idx, h in hashes.items()}
+    
+def write_song_length_database(database, fn):
+    with open(fn, "w", newline="") as f:
+        if fn.lower().endswith(".csv"):
+            writer = csv.DictWriter(f, fieldnames=DATABASE_FIELDS)
+            writer.writeheader()
+            for entry in database.values():
+                writer.writerow(entry)
+        else:
+            json.dump(list(database.values()), f, indent=1)
+            
 if __name__ == "__main__":
-    import sys
+    import sys, argparse
+    
+    parser = argparse.ArgumentParser(description="Estimate the length of an FF6 song from an SPC, or of every song in a ROM.")
+    parser.add_argument("file", help="SPC file, or ROM file to build a song length database from")
+    parser.add_argument("-o", "--out", help="(ROM) write the database to this file, as CSV if it ends in .csv, otherwise JSON (default: ROMNAME_lengths.json)")
+    parser.add_argument("-c", "--cache", help="(ROM) reuse results for unchanged sequences from this file, and update it")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="(ROM) number of processes to trace with (default: one per CPU)")
+    args = parser.parse_args()
     
-    with open(sys.argv[1], "rb") as f:
-        spc = f.read()
+    with open(args.file, "rb") as f:
+        filedata = f.read()
         
-    data = spc[0x1D00:0x4900]
-    mfvi_trace(data)
+    if len(filedata) >= 0x300000:
+        database = song_length_database(filedata, jobs=args.jobs, cache_file=args.cache)
+        for entry in database.values():
+            if entry.get("error"):
+                print(f"{entry['id']}: {entry['error']}")
+            else:
+                print(f"{entry['id']}: intro {entry['intro_seconds']:7.2f}s  loop {entry['loop_seconds']:7.2f}s  total {entry['total_seconds']:7.2f}s")
+        outfile = args.out if args.out else os.path.splitext(args.file)[0] + "_lengths.json"
+        write_song_length_database(database, outfile)
+        print(f"Wrote {len(database)} songs to {outfile}")
+    else:
+        data = filedata[0x1D00:0x4900]
+        mfvi_trace(data)
     
\ No newline at end of file
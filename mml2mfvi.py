@@ -27,6 +27,7 @@
 #   maintainers can easily see and pull from.
 
 import sys, os, re, traceback, copy, math
+from collections import deque
 try:
     from mmltbl import *
 except ImportError:
@@ -52,6 +53,10 @@ def int_insert(data, position, newdata, length, reversed=True):
     if not reversed: l.reverse()
     return byte_insert(data, position, bytes(l), length)
 
+def le16(n):
+    # two-byte little endian value, truncated the same way as int_insert
+    return (int(n) & 0xFFFF).to_bytes(2, "little")
+
 def warn(fileid, cmd, msg):
     global mml_log
     m = "{}: WARNING: in {:<10}: {}".format(fileid, cmd, msg)
@@ -92,7 +97,76 @@ class Drum:
         else:
             self.delim, self.key, self.octave, self.note, self.params = None, None, None, None, None
         mlog("DRUM: [{}] {} -- o{} {} {}".format(self.delim, self.key, self.octave, self.note, self.params))
-        
+
+class MmlStream:
+    # Character stream over the flattened MML text. Reads advance a cursor
+    # instead of popping from the front of a list, and macro/drum expansions
+    # are pushed as new frames in front of the cursor, so the cost of a
+    # compile is linear in the length of the (expanded) text.
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.frames = []
+
+    def _next_frame(self):
+        # Drop exhausted frames. Returns False if nothing is left to read.
+        while self.pos >= len(self.text):
+            if not self.frames:
+                return False
+            self.text, self.pos = self.frames.pop()
+        return True
+
+    def __bool__(self):
+        return self._next_frame()
+
+    def push(self, text):
+        # Insert text to be read before anything else remaining in the stream
+        if not text:
+            return
+        if self.pos < len(self.text):
+            self.frames.append((self.text, self.pos))
+        self.text, self.pos = text, 0
+
+    def peek(self):
+        if not self._next_frame():
+            raise IndexError("peek from empty MML stream")
+        return self.text[self.pos]
+
+    def pop(self):
+        if not self._next_frame():
+            raise IndexError("pop from empty MML stream")
+        c = self.text[self.pos]
+        self.pos += 1
+        return c
+
+    def read_while(self, chars):
+        # Consume and return the longest run of characters found in chars
+        s = ""
+        while self._next_frame():
+            text, start = self.text, self.pos
+            end = start
+            while end < len(text) and text[end] in chars:
+                end += 1
+            s += text[start:end]
+            self.pos = end
+            if end < len(text):
+                break
+        return s
+
+    def read_through(self, delim):
+        # Consume and return everything up to and including the next delim
+        # (or everything remaining, if delim never appears)
+        s = ""
+        while self._next_frame():
+            end = self.text.find(delim, self.pos)
+            if end >= 0:
+                s += self.text[self.pos:end+1]
+                self.pos = end + 1
+                break
+            s += self.text[self.pos:]
+            self.pos = len(self.text)
+        return s
+
 def get_variant_list(mml, sfxmode=False):
     if isinstance(mml, str):
         mml = mml.splitlines()
@@ -334,9 +408,10 @@ def mml_to_akao(mml, fileid='mml', sfxmode=False, variant=None, inst_only=False)
         
     #generate instruments
     isets = {}
+    instlines = [line for line in mml if line.upper().startswith(("#WAVE", "#BRR"))]
     for k, v in variants.items():
         iset = {}
-        for line in mml:
+        for line in instlines:
             uline = line.upper()
             if uline.startswith("#WAVE") or uline.startswith("#BRR"):
                 for c in v:
@@ -370,10 +445,10 @@ def mml_to_akao(mml, fileid='mml', sfxmode=False, variant=None, inst_only=False)
                     warn(fileid, "#WAVE {}, {}".format(hex(numbers[0]), hex(numbers[1])), "Sample ID out of range (expected 0x00 - 0xFF / 0 - 255)")
                     continue
                 iset[numbers[0]] = numbers[1]
-        raw_iset = b"\x00" * 0x20
+        raw_iset = bytearray(0x20)
         for slot, inst in iset.items():
-            raw_iset = byte_insert(raw_iset, (slot - 0x20)*2, bytes([inst]))
-        isets[k] = raw_iset
+            raw_iset[(slot - 0x20)*2] = inst
+        isets[k] = bytes(raw_iset)
                 
     #return if only parsing for inst
     if inst_only:
@@ -383,11 +458,17 @@ def mml_to_akao(mml, fileid='mml', sfxmode=False, variant=None, inst_only=False)
             return isets
             
     #generate data
+    #variants with the same ignored delimiters (e.g. _default_ and the first
+    ##VARIANT) compile to the same data, so only build each set once
     datas = {}
+    compiled = {}
+    preprocessor = MmlPreprocessor(mml, fileid)
     for k, v in variants.items():
         if variant in variants and k != variant:
             continue
-        datas[k] = mml_to_akao_main(mml, v, fileid, all_delims)
+        if v not in compiled:
+            compiled[v] = mml_to_akao_main(mml, v, fileid, all_delims, preprocessor)
+        datas[k] = compiled[v]
     
     if variant in variants:
         return (datas[variant], isets[variant])
@@ -399,127 +480,218 @@ def mml_to_akao(mml, fileid='mml', sfxmode=False, variant=None, inst_only=False)
         return output
         
         
-def mml_to_akao_main(mml, ignore='', fileid='mml', all_delims=''):
-    mml = copy.copy(mml)
-    ##final bit of preprocessing
-    #single character macros
-    cdefs = {}
-    for line in mml:
-        if line.lower().startswith("#cdef"):
-            li = line[5:]
-            li = li.split('#')[0].lower().strip()
-            li = li.split(None, 1)
-            if len(li) < 2: continue
-            if len(li[0]) != 1:
-                warn(fileid, line, "Expected one character for cdef, found {} ({})").format(len(li[0]), li[0])
-                continue
-            cdefs[li[0]] = li[1]
-    #single quote macros
-    macros = {}
-    for line in mml:
-        if line.lower().startswith("#def"):
-            line = line[4:]
-            line = line.split('#')[0].lower()
-            if not line: continue
-            pre, sep, post = line.partition('=')
-            if post:
-                pre = pre.replace("'", "").strip()
-                for c in ignore:
-                    try:
-                        post = re.sub(re.escape(c)+".*?"+re.escape(c), "", post)
-                    except Exception:
-                        c = "\\" + c
-                        post = re.sub(re.escape(c)+".*?"+re.escape(c), "", post)
-                    post = "".join(post.split())
-                macros[pre] = post.lower()
+class MmlPreprocessor:
+    # Parts of mml_to_akao_main's preprocessing that don't depend on which
+    # variant is being built. One of these is shared between all variants
+    # of a file; #cdef and #def lines are parsed once, and macro expansion is
+    # cached by the set of macros in effect, so variants whose delimiters
+    # don't touch any #def reuse the same expanded text.
+    def __init__(self, mml, fileid='mml'):
+        self.mml = list(mml)
+        self.fileid = fileid
+        self.expansions = {}
+        
+        #single character macros
+        self.cdefs = {}
+        for line in self.mml:
+            if line.lower().startswith("#cdef"):
+                li = line[5:]
+                li = li.split('#')[0].lower().strip()
+                li = li.split(None, 1)
+                if len(li) < 2: continue
+                if len(li[0]) != 1:
+                    warn(fileid, line, "Expected one character for cdef, found {} ({})").format(len(li[0]), li[0])
+                    continue
+                self.cdefs[li[0]] = li[1]
+        #single quote macros, before removing conditional text
+        self.defs = []
+        for line in self.mml:
+            if line.lower().startswith("#def"):
+                line = line[4:]
+                line = line.split('#')[0].lower()
+                if not line: continue
+                pre, sep, post = line.partition('=')
+                if post:
+                    pre = pre.replace("'", "").strip()
+                    self.defs.append((pre, post))
+                    
+    def get_macros(self, ignore=''):
+        macros = {}
+        for pre, post in self.defs:
+            for c in ignore:
+                try:
+                    post = re.sub(re.escape(c)+".*?"+re.escape(c), "", post)
+                except Exception:
+                    c = "\\" + c
+                    post = re.sub(re.escape(c)+".*?"+re.escape(c), "", post)
+                post = "".join(post.split())
+            macros[pre] = post.lower()
+        return macros
+        
+    def expand(self, ignore=''):
+        # Returns (lines, text): the file with all macros expanded, and the
+        # same with comments removed, lowercased and joined for compiling.
+        macros = self.get_macros(ignore)
+        # ignore only affects expansion through delimiters inside macro bodies
+        skip = frozenset(c for c in ignore if any(c in v for v in macros.values()))
+        key = (tuple(macros.items()), skip)
+        if key not in self.expansions:
+            lines = expand_macros(self.mml, macros, ignore, self.fileid)
+            text = " ".join([line.split('#')[0].lower() for line in lines])
+            self.expansions[key] = (lines, text)
+        return self.expansions[key]
+        
+macro_ref_re = re.compile(r"'(.*?)'")
+macro_name_re = re.compile(r"([^+\-*]+)")
+macro_tweak_re = re.compile(r"([+\-*])([%a-z]+)([0-9.,]+)")
+
+def compile_macro(s, skip):
+    # Split a macro body into tokens that tweaks can be applied to:
+    #   ("raw", text) -- passed through as is (delimited/braced text)
+    #   ("quote", text) -- nested macro reference, tweaks are appended to it
+    #   ("cmd", c, d, cmd) -- command c with parameters d, keyed as cmd
+    tokens = []
+    i, n = 0, len(s)
+    while i < n:
+        c = s[i]
+        i += 1
+        if c in skip:
+            endat = "}" if c=="{" else c
+            if i < n:
+                c += s[i]
+                i += 1
+            j = s.find(endat, i)
+            if j < 0:
+                tokens.append(("raw", c + s[i:]))
+                i = n
+            elif endat == "'":
+                tokens.append(("quote", c + s[i:j]))
+                i = j + 1
+            else:
+                tokens.append(("raw", c + s[i:j+1]))
+                i = j + 1
+            continue
+        if i < n and c == "%":
+            c += s[i]
+            i += 1
+        j = i
+        while j < n and s[j] in "1234567890,.+-x":
+            j += 1
+        d = s[i:j]
+        i = j
+        cmd = c + ''.join([ch for ch in d if ch == ','])
+        tokens.append(("cmd", c, d, cmd))
+    return tokens
     
+def apply_macro_tweaks(tokens, tweaks, tweak_text, ref, s, m, fileid='mml'):
+    # "o,,": ("+", ",1,")
+    sr = []
+    for token in tokens:
+        if token[0] == "raw":
+            sr.append(token[1])
+            continue
+        if token[0] == "quote":
+            sr.append(token[1] + tweak_text + "'")
+            continue
+        _, c, d, cmd = token
+        if d and (cmd in tweaks):
+            d = d.split(',')
+            e = tweaks[cmd][1].split(',')
+            sign = tweaks[cmd][0]
+            for j, ee in enumerate(e):
+                if not ee:
+                    c += f"{d[j]},"
+                    continue
+                try: en = int(ee)
+                except:
+                    try: en = int(ee,16)
+                    except:
+                        try: en = float(ee)
+                        except:
+                            warn(fileid, s, "error parsing {} into {}".format(ref, s))
+                            en = 0
+                try: dn = int(d[j])
+                except:
+                    try: dn = int(d[j],16)
+                    except:
+                        warn(fileid, m, "error parsing {} into {}".format(ref, s))      
+                        dn = 0
+                if sign == "*":
+                    result = dn * en
+                elif sign == "-":
+                    result = dn - en
+                elif sign == "+":
+                    result = dn + en
+                if result < 0: result = 0
+                if ((cmd == "v" or cmd == "p") and j==0) or ((cmd == "v," or cmd == "p,") and j==1):
+                    if result > 127: result = 127
+                else:
+                    if result > 255: result = 255
+                #apply new values
+                c += f"{int(result)},"
+            c = c.rstrip(',')
+        else: c += d
+        sr.append(c)
+    return "".join(sr)
+    
+def expand_macros(mml, macros, ignore='', fileid='mml'):
+    # Each macro body is tokenized once, and each distinct reference
+    # (macro name plus tweaks) is expanded once and then reused.
+    skip = ignore + "\"'{"
+    compiled = {}
+    expansions = {}
+    
+    def expand(ref):
+        mx = ref[1:-1]
+        m = macro_name_re.search(mx).group(1)
+        tweaks = {}
+        tweak_text = ""
+        while True:
+            twx = macro_tweak_re.search(mx)
+            if not twx: break
+            tweak_text += twx.group(0)
+            cmd = twx.group(2) + ''.join([c for c in twx.group(3) if c == ','])
+            tweaks[cmd] = (twx.group(1), twx.group(3))
+            mx = mx.replace(twx.group(0), "", 1)
+        s = macros[m.lower()] if m.lower() in macros else ""
+        if tweaks:
+            if m.lower() not in compiled:
+                compiled[m.lower()] = compile_macro(s, skip)
+            s = apply_macro_tweaks(compiled[m.lower()], tweaks, tweak_text, ref, s, m, fileid)
+        return s
+        
+    mml = copy.copy(mml)
     for i, line in enumerate(mml):
+        if "'" not in line:
+            mml[i] = line.replace('\n', ' ')
+            continue
+        out = []
+        pos = 0
         while True:
-            r = re.search(r"'(.*?)'", line)
+            r = macro_ref_re.search(line, pos)
             if not r: break
-            mx = r.group(1)
-            #
-            m = re.search(r"([^+\-*]+)", mx).group(1)
-            tweaks = {}
-            tweak_text = ""
-            while True:
-                twx = re.search(r"([+\-*])([%a-z]+)([0-9.,]+)", mx)
-                if not twx: break
-                tweak_text += twx.group(0)
-                cmd = twx.group(2) + ''.join([c for c in twx.group(3) if c == ','])
-                tweaks[cmd] = (twx.group(1), twx.group(3))
-                mx = mx.replace(twx.group(0), "", 1)
-            #
-            s = macros[m.lower()] if m.lower() in macros else ""
-            p = 0
-            if tweaks:
-                # "o,,": ("+", ",1,")
-                skip = ignore + "\"'{"
-                sq = list(s)
-                sr = ""
-                while sq:
-                    c = sq.pop(0)
-                    if c in skip:
-                        endat = "}" if c=="{" else c
-                        if sq: c += sq.pop(0)
-                        while sq:
-                            cc = sq.pop(0)
-                            if cc == endat:
-                                if endat == "'": c += tweak_text
-                                c += cc
-                                break
-                            else: c += cc
-                        sr += c
-                        continue
-                    if sq and c == "%":
-                        c += sq.pop(0)
-                    d = ""
-                    while sq and sq[0] in "1234567890,.+-x":
-                        d += sq.pop(0)
-                    cmd = c + ''.join([ch for ch in d if ch == ','])
-                    if d and (cmd in tweaks):
-                        d = d.split(',')
-                        e = tweaks[cmd][1].split(',')
-                        sign = tweaks[cmd][0]
-                        for j, ee in enumerate(e):
-                            if not ee:
-                                c += f"{d[j]},"
-                                continue
-                            try: en = int(ee)
-                            except:
-                                try: en = int(ee,16)
-                                except:
-                                    try: en = float(ee)
-                                    except:
-                                        warn(fileid, s, "error parsing {} into {}".format(r.group(0), s))
-                                        en = 0
-                            try: dn = int(d[j])
-                            except:
-                                try: dn = int(d[j],16)
-                                except:
-                                    warn(fileid, m, "error parsing {} into {}".format(r.group(0), s))      
-                                    dn = 0
-                            if sign == "*":
-                                result = dn * en
-                            elif sign == "-":
-                                result = dn - en
-                            elif sign == "+":
-                                result = dn + en
-                            if result < 0: result = 0
-                            if ((cmd == "v" or cmd == "p") and j==0) or ((cmd == "v," or cmd == "p,") and j==1):
-                                if result > 127: result = 127
-                            else:
-                                if result > 255: result = 255
-                            #apply new values
-                            c += f"{int(result)},"
-                        c = c.rstrip(',')
-                    else: c += d
-                    sr += c
-                s = sr
-                                                    
-            line = line.replace(r.group(0), s, 1)
-            
-        mml[i] = line.replace('\n', ' ')
+            ref = r.group(0)
+            if ref not in expansions:
+                expansions[ref] = expand(ref)
+            s = expansions[ref]
+            out.append(line[pos:r.start()])
+            if "'" in s:
+                # expansion has nested references, so rescan it
+                line = s + line[r.end():]
+                pos = 0
+            else:
+                out.append(s)
+                pos = r.end()
+        out.append(line[pos:])
+        mml[i] = "".join(out).replace('\n', ' ')
+        
+    return mml
+
+def mml_to_akao_main(mml, ignore='', fileid='mml', all_delims='', preprocessor=None):
+    if preprocessor is None:
+        preprocessor = MmlPreprocessor(mml, fileid)
+    cdefs = preprocessor.cdefs
+    mml, text = preprocessor.expand(ignore)
         
     #drums
     drums = {}
@@ -536,99 +708,89 @@ def mml_to_akao_main(mml, ignore='', fileid='mml', all_delims=''):
                 if d.delim not in drums: drums[d.delim] = {}
                 drums[d.delim][d.key] = d
     
-    for i, line in enumerate(mml):
-        mml[i] = line.split('#')[0].lower()
-            
-    m = list(" ".join(mml))
+    m = MmlStream(text)
     targets, channels, pendingjumps = {}, {}, {}
-    data = b"\x00" * 0x26
+    #output is built in place; jumps to targets not yet seen are written as
+    #placeholders and recorded in pendingjumps, then patched once at the end
+    data = bytearray(0x26)
     defaultlength = 8
     thissegment = 1
     next_jumpid = 1
     state = {}
     jumpout = []
     
-    while len(m):
-        command = m.pop(0)
+    while m:
+        command = m.pop()
                         
         #single character macros
         if command in cdefs:
-            repl = list(cdefs[command] + " ")
-            m = repl + m
+            m.push(cdefs[command] + " ")
         #conditionally executed statements
         if command in ignore:
-            while len(m):
-                next = m.pop(0)
-                if next == command:
-                    break
+            m.read_through(command)
             continue
         #inline comment // channel marker
         elif command == "{":
             thisnumber = ""    
             numbers = []
-            while len(m):
-                command += m.pop(0)
-                if command[-1] in "1234567890":
-                    thisnumber += command[-1]
+            for c in m.read_through("}"):
+                if c in "1234567890":
+                    thisnumber += c
                 elif thisnumber:
                     numbers.append(int(thisnumber))
                     thisnumber = ""
-                if command[-1] == "}": break
             for n in numbers:
                 if n <= 16 and n >= 1:
                     channels[n] = len(data)
             continue
         #drum mode
         elif command in drums:
-            mls, dms = [], []
+            mls = []
             drumset = drums[command]
-            while len(m):
-                if m[0] != command:
-                    dms.append(m.pop(0))
-                else:
-                    m.pop(0)
-                    break
-            dbgdms = "".join(dms)
+            dbgdms = m.read_through(command)
+            if dbgdms.endswith(command):
+                dbgdms = dbgdms[:-1]
+            dms = deque(dbgdms)
             lockstate = False
             silent = False
             if len(dms):
                 if dms[0] in "1234567890":
-                    state["o0"] = dms.pop(0)
+                    state["o0"] = dms.popleft()
                 elif dms[0] == ">":
-                    co = dms.pop(0)
+                    co = dms.popleft()
                     while dms[0] == ">":
-                        co += dms.pop(0)
+                        co += dms.popleft()
                     if "o0" in state:
                         state["o0"] += len(co)
                 elif dms[0] == "<":
-                    co = dms.pop(0)
+                    co = dms.popleft()
                     while dms[0] == "<":
-                        co += dms.pop(0)
+                        co += dms.popleft()
                     if "o0" in state:
                         state["o0"] -= len(co)
             while len(dms):
                 if "m0,0" in state:
                     state.pop("m0,0", None)
-                dcom = dms.pop(0)
+                dcom = dms.popleft()
                 if len(dms):
                     if dms[0] in "+-":
-                        dcom += dms.pop(0)
+                        dcom += dms.popleft()
                 if dcom == "\\":
                     lockstate = True if not lockstate else False
                 elif dcom == ":":
                     silent = True if not silent else False
                 elif dcom == "!":
-                    rcom = dms.pop(0)
+                    rcom = dms.popleft()
                     if rcom == "!":
                         if "o0" in state:
                             state = {"o0": state["o0"]}
                         else:
                             state = {}
                         continue
-                    if rcom == "%": rcom += dms.pop(0)
+                    if rcom == "%": rcom += dms.popleft()
                     while len(dms):
                         if dms[0] in "0,":
-                            rcom += dms.pop(0)
+                            rcom += dms.popleft()
                         else: break
                     if rcom in equiv_tbl:
                         rcom = equiv_tbl[rcom]
@@ -681,24 +843,20 @@ def mml_to_akao_main(mml, ignore='', fileid='mml', all_delims=''):
                     s += drumset[dcom].note
                     if not silent: mls.extend(list(s))
             mlog("drum: processed {} -> {}".format(dbgdms, "".join(mls)))
-            mls.extend(m)
-            m = mls
+            m.push("".join(mls))
             continue
             
         #populate command variables
-        if command == "%": command += m.pop(0)
+        if command == "%": command += m.pop()
         prefix = command
-        if len(m):
-            while m[0] in "1234567890,.+-x":
-                command += m.pop(0)
-                if not len(m): break
+        command += m.read_while("1234567890,.+-x")
         
         #catch @0x before parsing params
         if "|" in command:
             command = "@0x2" + command[1:]
         if "@0x" in command:
             while len(command) < 5:
-                command += m.pop(0)
+                command += m.pop()
             number = command[-2:]
             try:
                 number = int(number, 16)
@@ -819,7 +977,7 @@ def mml_to_akao_main(mml, ignore='', fileid='mml', all_delims=''):
                     data += b"\xEB"
                     thissegment += 1
                     continue
-            data += b"\xF6" + int_insert(b"\x00\x00",0,target,2)
+            data += b"\xF6" + le16(target)
             thissegment += 1
         #case: jump out of loop
         elif prefix == "j":
@@ -836,7 +994,7 @@ def mml_to_akao_main(mml, ignore='', fileid='mml', all_delims=''):
             if params[0] >= 256:
                 warn(fileid, command, "Parameter {} out of range, substituting 1".format(params[0]))
                 params[0] = 1
-            data += b"\xF5" + bytes([params[0]]) + int_insert(b"\x00\x00",0,target,2)
+            data += b"\xF5" + bytes([params[0]]) + le16(target)
         #case: hard jump without ending segment
         elif prefix == "%j":
             if len(params)==1:
@@ -846,7 +1004,7 @@ def mml_to_akao_main(mml, ignore='', fileid='mml', all_delims=''):
                     target = len(data)
                     pendingjumps[len(data)+1] = params[0]
             else: continue
-            data += b"\xF6" + int_insert(b"\x00\x00",0,target,2)
+            data += b"\xF6" + le16(target)
         #case: conditional jump
         elif prefix == ":" and len(params) == 1:
             if params[0] in targets:
@@ -854,28 +1012,27 @@ def mml_to_akao_main(mml, ignore='', fileid='mml', all_delims=''):
             else:
                 target = len(data)
                 pendingjumps[len(data)+1] = params[0]
-            data += b"\xFC" + int_insert(b"\x00\x00",0,target,2)
+            data += b"\xFC" + le16(target)
     
     #insert pending jumps
     for k, v in pendingjumps.items():
         if v in targets:
-            data = int_insert(data, k, targets[v], 2)
+            data[k:k+2] = le16(targets[v])
         else:
             warn(fileid, command, "Jump destination {} not found in file".format(v))
     #set up header
-    header = int_insert(b"\x00"*0x26, 0, len(data)-3, 2)
-    header = int_insert(header, 2, 0x26, 2)
-    header = int_insert(header, 4, len(data), 2)
+    data[0:2] = le16(len(data)-3)
+    data[2:4] = le16(0x26)
+    data[4:6] = le16(len(data))
     for i in range(1,9):
         if i not in channels:
             channels[i] = len(data)
     for k, v in channels.items():
-        header = int_insert(header, 4 + k*2, v, 2)
+        data[4+k*2:6+k*2] = le16(v)
         if k <= 8 and k+8 not in channels:
-            header = int_insert(header, 4 + (k+8)*2, v, 2)
-    data = byte_insert(data, 0, header, 0x26)
+            data[4+(k+8)*2:6+(k+8)*2] = le16(v)
     
-    return data
+    return bytes(data)
     
 def clean_end():
     print("Processing ended.")
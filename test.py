@@ -1,22 +1,31 @@
 # Development tool to check if and where any changes to mml2mfvi cause changes to output of existing mml files
 # Expected directory structure:
 #       ./testing/mml2mfvi_ref.py -- reference script, baseline for comparison
-#       ./testing/mml2mfvi_alt.py -- altered script
+#       ./mml2mfvi.py -- current script
 #       ../johnnydmad/custom/ -- location of mml files used for comparison
+# usage: test.py [MMLPATH] [MMLPATH ...]
+# Any number of directories or single mml files can be given in place of the default.
 
 VERBOSE = False
 mmlpath = "../johnnydmad/custom/"
 
+import sys, time
 from os import path as ospath
 from glob import glob
 
 import testing.mml2mfvi_ref
-import testing.mml2mfvi_alt
+import mml2mfvi
 
-sourceglob = glob(ospath.join(mmlpath, "**", "*.mml"), recursive=True)
+sourceglob = []
+for p in (sys.argv[1:] if len(sys.argv) >= 2 else [mmlpath]):
+    if ospath.isdir(p):
+        sourceglob.extend(glob(ospath.join(p, "**", "*.mml"), recursive=True))
+    else:
+        sourceglob.extend(glob(p))
 
 srccount = len(sourceglob)
 count = 0
+ref_time, alt_time = 0.0, 0.0
 
 report_lines = []
 
@@ -25,47 +34,57 @@ print()
 def report(src, msg):
     report_lines.append(f"{src}: {msg}")
 
+def first_difference(a, b):
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i
+    return min(len(a), len(b))
+
 for source in sourceglob:
     with open(source, "r") as f:
         file = f.read()
-        
+
     if VERBOSE:
         print(f"ref: {source}")
+    t = time.perf_counter()
     ref = testing.mml2mfvi_ref.mml_to_akao(file)
+    ref_time += time.perf_counter() - t
     if VERBOSE:
         print(f"alt: {source}")
-    alt = testing.mml2mfvi_alt.mml_to_akao(file)
-    
+    t = time.perf_counter()
+    alt = mml2mfvi.mml_to_akao(file)
+    alt_time += time.perf_counter() - t
+
     variants = set(ref.keys()).union(set(alt.keys()))
     for v in variants:
         pv = "(default)" if v == "_default_" else f"[{v}]"
-        
+
         # check vs. calling mml_to_akao with a specific variant
         specific_variant_ref = testing.mml2mfvi_ref.mml_to_akao(file, variant=v)
-        specific_variant_alt = testing.mml2mfvi_alt.mml_to_akao(file, variant=v)
-        if ref[v] != specific_variant_ref:
+        specific_variant_alt = mml2mfvi.mml_to_akao(file, variant=v)
+        if ref.get(v) != specific_variant_ref:
             report(source, f"{pv}: Mismatch between reference process(variant={v}) and process()[{v}]")
-        if alt[v] != specific_variant_alt:
-            report(source, f"{pv}: Mismatch between alternate process(variant={v}) and process()[{v}]")
+        if alt.get(v) != specific_variant_alt:
+            report(source, f"{pv}: Mismatch between current process(variant={v}) and process()[{v}]")
         # mimic insertmfvi's "init_from_import"
         brr_imports_ref = testing.mml2mfvi_ref.get_brr_imports(file, v)
         for k, importinfo in brr_imports_ref.items():
             importinfo[1] = testing.mml2mfvi_ref.parse_brr_loop(importinfo[1])
             importinfo[2] = testing.mml2mfvi_ref.parse_brr_tuning(importinfo[2])
             importinfo[3] = testing.mml2mfvi_ref.parse_brr_env(importinfo[3])
-        brr_imports_alt = testing.mml2mfvi_alt.get_brr_imports(file, v)
+        brr_imports_alt = mml2mfvi.get_brr_imports(file, v)
         for k, importinfo in brr_imports_alt.items():
-            importinfo[1] = testing.mml2mfvi_alt.parse_brr_loop(importinfo[1])
-            importinfo[2] = testing.mml2mfvi_alt.parse_brr_tuning(importinfo[2])
-            importinfo[3] = testing.mml2mfvi_alt.parse_brr_env(importinfo[3])
-        
+            importinfo[1] = mml2mfvi.parse_brr_loop(importinfo[1])
+            importinfo[2] = mml2mfvi.parse_brr_tuning(importinfo[2])
+            importinfo[3] = mml2mfvi.parse_brr_env(importinfo[3])
+
         if v not in ref.keys():
             report(source, f"Testing produced variant {pv} not found in reference")
         elif v not in alt.keys():
             report(source, f"Testing lacks variant {pv} found in reference")
         else:
             if ref[v][0] != alt[v][0]:
-                report(source, f"{pv}: Sequence mismatch")
+                report(source, f"{pv}: Sequence mismatch (first difference at 0x{first_difference(ref[v][0], alt[v][0]):04X})")
             if ref[v][1] != alt[v][1]:
                 report(source, f"{pv}: Instrument mismatch")
             if brr_imports_ref != brr_imports_alt:
@@ -75,18 +94,19 @@ for source in sourceglob:
                     print()
                     print(brr_imports_alt)
                     print()
-    
+
     count += 1
     display = f"[{len(report_lines)}] Tested file {count} of {srccount} -- {source}"
     if VERBOSE:
         print(f"{display:80}", end="\n")
     else:
         print(f"{display:80}", end="\r")
-    
+
 print("\n\n")
 for line in report_lines:
     print(line)
-    
+
+print(f"\nreference: {ref_time:.2f}s, current: {alt_time:.2f}s (all variants, {srccount} files)")
 print("\n[done.]")
-input()
-            
\ No newline at end of file
+if sys.stdin.isatty():
+    input()
@@ -0,0 +1,78 @@
+# Development tool to time mfvi2mml decompilation over a corpus of sequences
+# usage (from the mfvitools directory):
+#       python -m testing.bench_mfvi2mml [-n REPEATS] [PATH ...]
+# Each PATH can be a directory, a glob, or a single file. Binary sequences
+# (*.bin, as written by mass_extract/sqspcmml, with their _inst.bin if present)
+# are decompiled directly; *.mml files are compiled with mml2mfvi first (not
+# included in the timing) so any MML collection can be used as a corpus.
+
+import sys, time, io, contextlib, argparse
+from os import path as ospath
+from glob import glob
+
+import mml2mfvi
+import mfvi2mml
+import mfvidisasm
+
+parser = argparse.ArgumentParser()
+parser.add_argument("paths", nargs="*", default=["../johnnydmad/custom/"])
+parser.add_argument("-n", "--repeats", type=int, default=3, help="decompile each sequence this many times and keep the best time")
+args = parser.parse_args()
+
+files = []
+for p in args.paths:
+    if ospath.isdir(p):
+        files.extend(glob(ospath.join(p, "**", "*.mml"), recursive=True))
+        files.extend(glob(ospath.join(p, "**", "*.bin"), recursive=True))
+    else:
+        files.extend(glob(p))
+files = [f for f in sorted(set(files)) if not f.endswith("_inst.bin")]
+
+# (name, data, inst, long_header)
+sequences = []
+for fn in files:
+    if fn.endswith(".mml"):
+        with open(fn, "r") as f:
+            mml = f.read()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                variants = mml2mfvi.mml_to_akao(mml, fn)
+        except Exception as e:
+            print(f"{fn}: couldn't compile ({type(e).__name__})")
+            continue
+        for v, (data, inst) in variants.items():
+            sequences.append((f"{fn} [{v}]", data, inst, False))
+    else:
+        with open(fn, "rb") as f:
+            data = f.read()
+        inst = None
+        if fn.endswith("_data.bin"):
+            try:
+                with open(fn[:-9] + "_inst.bin", "rb") as f:
+                    inst = f.read()
+            except OSError:
+                pass
+        sequences.append((fn, data, inst, False))
+
+total_time, total_bytes, total_lines = 0.0, 0, 0
+for name, data, inst, force_short_header in sequences:
+    best = None
+    for i in range(args.repeats):
+        mfvidisasm._cache.clear()
+        t = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                mml = mfvi2mml.akao_to_mml(data, inst, force_short_header=force_short_header)
+        except Exception as e:
+            print(f"{name}: failed ({type(e).__name__})")
+            break
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    else:
+        total_time += best
+        total_bytes += len(data)
+        total_lines += len(mml)
+        print(f"{best*1000:8.2f}ms  {len(data):6} bytes  {name}")
+
+print(f"\n{len(sequences)} sequences, {total_bytes} bytes, {total_lines} lines of MML")
+print(f"total (best of {args.repeats}): {total_time:.3f}s")
@@ -63,14 +63,8 @@ def mlog(msg):
     if __name__ == "__main__": mml_log += msg + '\n'
     
 class Drum:
-    def __init__(self, st):
-        # hack - strip common variant markers from after delimiter before processing
-        a, b = st.split('=')
-        for c in ["~", "/", "`", "\?", "_"]:
-            b = re.sub(c, '', b)
-        st = "=".join([a, b])
-    
-        s = re.findall('(.)(.[+-]?)\\1=\s*([0-9]?)([a-gr^])([+-]?)\s*(.*)', st)
+    def __init__(self, st):    
+        s = re.findall(r'(.)(.[+-]?)\1=\s*([0-9]?)([a-gr^])([+-]?)\s*(.*)', st)
         if s: s = s[0]
         mlog("{} -> {}".format(st, s))
         if len(s) >= 6:
@@ -78,8 +72,8 @@ class Drum:
             self.key = s[1]
             self.octave = int(s[2]) if s[2] else 5
             self.note = s[3] + s[4]
-            s5 = re.sub('\s*', '', s[5]).lower()
-            params = re.findall("\|[0-9a-f]|@0x[0-9a-f][0-9a-f]|%?[^|0-9][0-9,\-]*", s5)
+            s5 = re.sub(r'\s*', '', s[5]).lower()
+            params = re.findall(r"\|[0-9a-f]|@0x[0-9a-f][0-9a-f]|%?[^|0-9][0-9,\-]*", s5)
             par = {}
             for p in params:
                 if p[0] == "@" and len(p) >= 5:
@@ -89,8 +83,8 @@ class Drum:
                 if p[0] == '|' and len(p) >= 2:
                     par['@0'] = str(int(p[1], 16) + 32)
                 else:
-                    pre = re.sub('[0-9\-]+', '0', p)
-                    suf = re.sub('%?[^0-9]', '', p, 1)
+                    pre = re.sub(r'[0-9\-]+', '0', p)
+                    suf = re.sub(r'%?[^0-9]', '', p, 1)
                     if pre in equiv_tbl:
                         pre = equiv_tbl[pre]
                     par[pre] = suf
@@ -140,7 +134,7 @@ def get_echo_delay(mml, variant=None):
             for c in vtokens:
                 if c in line:
                     line = re.sub(re.escape(c)+'.*?'+re.escape(c), '', line)
-            line = re.sub('[^0-9]+', '', line)
+            line = re.sub(r'[^0-9]+', '', line)
             try:
                 num = int(line)
             except ValueError:
@@ -234,12 +228,12 @@ def parse_brr_tuning(pitchtext):
     semitones = None
     pitchscale = None
     try:
-        match = re.fullmatch("(\\^?)([a-g])([+-]?)\\s?([+-]\\d+)", pitchtext)
+        match = re.fullmatch(r"(\^?)([a-g])([+-]?)\s?([+-]\d+)", pitchtext)
         if match:
             high, key, mod, cents = match.group(1, 2, 3, 4)
             cents = int(cents)
         if not match:
-            match = re.fullmatch("(\\^?)([a-g])([+-]?)", pitchtext)
+            match = re.fullmatch(r"(\^?)([a-g])([+-]?)", pitchtext)
             if match:
                 high, key, mod = match.group(1, 2, 3)
                 cents = 0
@@ -282,7 +276,7 @@ def parse_brr_env(envtext):
     byteenv = None
     try:
         envsplit = envtext.split()
-        match = re.fullmatch("a(\\d\\d?)\\s?[dy](\\d)\\s?s(\\d)\\s?r(\\d\\d?)", envtext)
+        match = re.fullmatch(r"a(\d\d?)\s?[dy](\d)\s?s(\d)\s?r(\d\d?)", envtext)
         if match:
             attack, decay, sustain, release = match.group(1, 2, 3, 4)
         elif len(envsplit) >= 4:
@@ -328,6 +322,9 @@ def mml_to_akao(mml, fileid='mml', sfxmode=False, variant=None, inst_only=False)
         mml = newmml
     
     variants = get_variant_list(mml, sfxmode)
+    all_delims = set()
+    for k, v in variants.items():
+        all_delims.update(v)
     if variant:
         if variant not in variants:
             print("mml error: requested unknown variant '{}'\n".format(variant))
@@ -353,7 +350,7 @@ def mml_to_akao(mml, fileid='mml', sfxmode=False, variant=None, inst_only=False)
                 line = "#WAVE " + line
                 uline = line.upper()
             if uline.startswith("#WAVE") and len(line) > 5:
-                line = re.sub('[^x\da-fA-F]', ' ', line[5:])
+                line = re.sub(r'[^x\da-fA-F]', ' ', line[5:])
                 tokens = line.split()
                 if len(tokens) < 2: continue
                 numbers = []
@@ -390,7 +387,7 @@ def mml_to_akao(mml, fileid='mml', sfxmode=False, variant=None, inst_only=False)
     for k, v in variants.items():
         if variant in variants and k != variant:
             continue
-        datas[k] = mml_to_akao_main(mml, v, fileid)
+        datas[k] = mml_to_akao_main(mml, v, fileid, all_delims)
     
     if variant in variants:
         return (datas[variant], isets[variant])
@@ -402,7 +399,7 @@ def mml_to_akao(mml, fileid='mml', sfxmode=False, variant=None, inst_only=False)
         return output
         
         
-def mml_to_akao_main(mml, ignore='', fileid='mml'):
+def mml_to_akao_main(mml, ignore='', fileid='mml', all_delims=''):
     mml = copy.copy(mml)
     ##final bit of preprocessing
     #single character macros
@@ -438,15 +435,15 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
     
     for i, line in enumerate(mml):
         while True:
-            r = re.search("'(.*?)'", line)
+            r = re.search(r"'(.*?)'", line)
             if not r: break
             mx = r.group(1)
             #
-            m = re.search("([^+\-*]+)", mx).group(1)
+            m = re.search(r"([^+\-*]+)", mx).group(1)
             tweaks = {}
             tweak_text = ""
             while True:
-                twx = re.search("([+\-*])([%a-z]+)([0-9.,]+)", mx)
+                twx = re.search(r"([+\-*])([%a-z]+)([0-9.,]+)", mx)
                 if not twx: break
                 tweak_text += twx.group(0)
                 cmd = twx.group(2) + ''.join([c for c in twx.group(3) if c == ','])
@@ -531,13 +528,9 @@ def mml_to_akao_main(mml, ignore='', fileid='mml'):
             s = line[5:].strip()
             s = s.split('#')[0].lower()
             for c in ignore:
-                try:
-                    s = re.sub(re.escape(c)+".*?"+re.escape(c), "", s)
-                except Exception:
-                    c = "\\" + c
-                    s = re.sub(re.escape(c)+".*?"+re.escape(c), "", s)
-            #for c in ["~", "/", "`", "\?", "_"]:
-            #    s = re.sub(c, '', s)
+                s = re.sub(re.escape(c)+".*?"+re.escape(c), "", s)
+            for c in all_delims:
+                s = re.sub(re.escape(c), '', s)
             d = Drum(s.strip())
             if d.delim:
                 if d.delim not in drums: drums[d.delim] = {}
@@ -0,0 +1,40 @@
+# Checks for mfvitrace song length detection
+# usage (from the mfvitools directory):
+#       python -m testing.test_mfvitrace
+# or run with pytest.
+
+import io, contextlib
+
+import mfvitrace
+
+def make_sequence(*tracks, base=0x1C00):
+    # Short-header AKAO4 sequence with up to 8 tracks; unused tracks point at
+    # the end address, so they start out stopped
+    data = b""
+    addrs = []
+    for track in tracks:
+        addrs.append(base + len(data))
+        data += bytes(track)
+    end = base + len(data)
+    addrs += [end] * (8 - len(addrs))
+    pointers = b"".join(a.to_bytes(2, "little") for a in addrs)
+    return base.to_bytes(2, "little") + end.to_bytes(2, "little") + pointers + pointers + data
+
+def trace(data, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return mfvitrace._mfvi_trace(data, **kwargs)
+
+def test_song_without_loop():
+    # tempo 0x80, twenty whole notes, end of track
+    data = make_sequence([0xF0, 0x80] + [0x00] * 20 + [0xEB])
+    seconds = trace(data)
+    assert seconds == trace(data, hashed=False)
+    assert 30 < seconds < 999
+    # once every track has stopped, the state repeats every tick
+    _, loop_start, loop_length = trace(data, return_loop=True)
+    assert loop_start >= 20 * 192
+    assert loop_length == 1
+
+if __name__ == "__main__":
+    test_song_without_loop()
+    print("OK")